@@ -0,0 +1,420 @@
+'''Benchmarks for Lethal Terminal, they type into a virtual terminal instead of the game
+
+python benchmark.py hook
+python benchmark.py ui
+python benchmark.py session --session all
+python benchmark.py jitter
+python benchmark.py replay session.ltrec
+python benchmark.py emitter
+python benchmark.py control
+'''
+import argparse
+import io
+import logging
+import os
+import threading
+from time import perf_counter, sleep
+from typing import List, Optional, Tuple
+from rich.console import Console
+
+from src.keyboard_manager import KeyboardManager, create_keyboard_manager
+from src.process_emitter import ProcessKeyboardManager
+from src.output_backend import VirtualTerminalBackend, KeyEvent, KEY_DOWN, KEY_UP
+from src.simulated_terminal import SimulatedGameTerminal
+from src.key_clock import KeyClock
+from src.control_server import ControlServer
+from src.control_client import ControlClient
+from src.session_recorder import SessionRecorder, SessionReplayer, load_session, keys_of_kind, EMITTED
+from src.terminal_state_manager import TerminalStateManager
+from src.traps import parse_trap_ranges
+from src.terminal_ui import TerminalUI
+
+logger = logging.getLogger("Lethal Terminal Benchmark")
+
+def create_managers(backend: VirtualTerminalBackend, recorder: Optional[SessionRecorder] = None) -> Tuple[KeyboardManager, TerminalStateManager]:
+    keyboard_manager = create_keyboard_manager(logger, backend, recorder)
+    # Never touch the traps kept between runs of the app
+    return keyboard_manager, TerminalStateManager(keyboard_manager, logger, traps_file="")
+
+def benchmark_hook(cycles: int) -> None:
+    '''Rapid GAMEPLAY -> TERMINAL -> ADD_TRAP -> TERMINAL -> DELETE_TRAP -> TERMINAL -> GAMEPLAY transitions.
+
+    Every key down must reach the state machine, and be blocked only outside of GAMEPLAY'''
+    backend = VirtualTerminalBackend()
+    keyboard_manager, state_manager = create_managers(backend)
+    callback = backend.callbacks[0]
+
+    handled = 0
+    handle_key_buffer = state_manager.handle_key_buffer
+    def counting_handle_key_buffer(event):
+        nonlocal handled
+        handled += 1
+        handle_key_buffer(event)
+    state_manager.handle_key_buffer = counting_handle_key_buffer
+
+    cycle_keys = ['t', 'enter', 'a', 'b', '1', 'x', 'b', '1', 'tab', 'tab']
+    # Only 't enter' is pressed in GAMEPLAY. Known up front, the hook must not depend on when the keys are handled
+    cycle_passes = [True, True] + [False]*(len(cycle_keys) - 2)
+    sent = 0
+    wrong_suppression = 0
+    transitions = 0
+    state = state_manager.state
+    start = perf_counter()
+    try:
+        for _ in range(cycles):
+            for name, should_pass in zip(cycle_keys, cycle_passes):
+                if callback(KeyEvent(KEY_DOWN, name)) != should_pass:
+                    wrong_suppression += 1
+                # Key ups always reach the game
+                if not callback(KeyEvent(KEY_UP, name)):
+                    wrong_suppression += 1
+                if state_manager.state is not state:
+                    state = state_manager.state
+                    transitions += 1
+                sent += 1
+        elapsed = perf_counter() - start
+    finally:
+        state_manager.stop()
+        keyboard_manager.stop()
+
+    print(f"Keys sent:          {sent}")
+    print(f"Keys handled:       {handled}")
+    print(f"Keys dropped:       {sent - handled}")
+    print(f"Wrong suppression:  {wrong_suppression}")
+    print(f"State transitions:  {transitions}")
+    print(f"Hooks installed:    {len(backend.callbacks)}")
+    print(f"Time per key:       {elapsed / sent * 1e6:.1f}us")
+
+def benchmark_ui(frames: int, players: int, radars: int) -> None:
+    '''Frame build and render time with and without the render cache, for large lobbies'''
+    keyboard_manager, state_manager = create_managers(VirtualTerminalBackend())
+    terminal_ui = TerminalUI(state_manager)
+    terminal_ui.console = Console(file=io.StringIO(), width=120)
+    terminal_ui.players = [f"player{i + 1}" for i in range(players)]
+    terminal_ui.radars = [f"radar{i + 1}" for i in range(radars)]
+    state_manager.traps.update(f"{chr(ord('a') + i)}{i % 10}" for i in range(10))
+    state_manager.traps_version += 1
+
+    def frame_time(cached: bool) -> float:
+        start = perf_counter()
+        for i in range(frames):
+            # Every frame shows a new event, like typing would
+            state_manager.set_event(f"Event {i}")
+            if not cached:
+                terminal_ui.regions.clear()
+                terminal_ui.tables_cache.clear()
+            terminal_ui.update_regions()
+            terminal_ui.console.print(terminal_ui.build_frame())
+        return (perf_counter() - start) / frames
+
+    try:
+        uncached = frame_time(False)
+        cached = frame_time(True)
+    finally:
+        state_manager.stop()
+        keyboard_manager.stop()
+
+    print(f"Players, radars:    {players}, {radars}")
+    print(f"Uncached frame:     {uncached * 1e3:.3f}ms")
+    print(f"Cached frame:       {cached * 1e3:.3f}ms")
+    print(f"Speedup:            {uncached / cached:.1f}x")
+
+def type_user_keys(terminal: VirtualTerminalBackend, keys: List[str], interval: float = 0.05) -> None:
+    '''Type like a person would, through the keyboard hook'''
+    for key in keys:
+        terminal.send_user_key(key)
+        sleep(interval)
+
+def benchmark_session(session: str, duration: float, min_key_interval: float, record: Optional[str]) -> None:
+    '''Drive a realistic session into the simulated game terminal and report what actually landed'''
+    terminal = SimulatedGameTerminal(min_key_interval)
+    recorder = SessionRecorder(record) if record else None
+    keyboard_manager, state_manager = create_managers(terminal, recorder)
+    traps = ["a1", "b2", "c3", "d4", "e5", "f6", "g7", "h8", "i9", "j0"]
+
+    user_commands = 0
+    try:
+        # Open the terminal and wait for 'view monitor'
+        type_user_keys(terminal, ['t', 'enter'])
+        sleep(1.5)
+        terminal.reset()
+
+        if session == "all":
+            type_user_keys(terminal, ['q', 'q'])
+        else:
+            for trap in traps:
+                type_user_keys(terminal, ['a', *trap])
+
+        start = perf_counter()
+        while perf_counter() - start < duration:
+            if session == "interleaved":
+                # A ping, a transmit and a switch every few seconds
+                type_user_keys(terminal, ['p', '1'])
+                sleep(1)
+                type_user_keys(terminal, ['t', 'h', 'i', 'enter'])
+                sleep(1)
+                type_user_keys(terminal, ['s', '2'])
+                user_commands += 3
+            sleep(1)
+        elapsed = perf_counter() - start
+
+        type_user_keys(terminal, ['tab', 'tab'])
+    finally:
+        state_manager.stop()
+        keyboard_manager.stop()
+        if recorder:
+            recorder.close()
+
+    landed = terminal.get_landed()
+    commands_landed = sum(1 for _, _, line in landed if line in ["ping radar1", "transmit hi", "switch player2"])
+    periods = terminal.trap_refresh_periods()
+    all_periods = [period for trap_periods in periods.values() for period in trap_periods]
+    refreshed_traps = {line for _, kind, line in landed if kind == "trap"}
+    expected_traps = 260 if session == "all" else len(traps)
+
+    print(f"Session:            {session} ({elapsed:.1f}s, min key interval {min_key_interval * 1e3:.1f}ms)")
+    print(f"Lines landed:       {len(landed)} ({len(landed) / elapsed:.1f}/s)")
+    print(f"Traps refreshed:    {len(refreshed_traps)}/{expected_traps}")
+    if len(all_periods) > 0:
+        print(f"Refresh period:     mean {sum(all_periods) / len(all_periods):.2f}s, max {max(all_periods):.2f}s")
+    if user_commands > 0:
+        print(f"User commands:      {commands_landed}/{user_commands} landed")
+    print(f"Rejected keys:      {terminal.rejected_keys}/{terminal.accepted_keys + terminal.rejected_keys}")
+    print(f"Error rate:         {terminal.error_rate() * 100:.1f}%")
+    queue_stats = state_manager.commands.get_stats()
+    print(f"Queue contention:   {queue_stats['contended']}")
+    for kind in ("system", "user_line", "trap_refresh"):
+        kind_stats = queue_stats[kind]
+        print(f"Queue {kind + ':':<13} {kind_stats['pushed']} pushed, {kind_stats['duplicates']} duplicates, "
+              f"wait mean {kind_stats['average_wait']:.1f}ms, max {kind_stats['max_wait']:.1f}ms")
+
+def benchmark_replay(path: str, fast: bool) -> None:
+    '''Replay the hooked keys of a recorded session, and compare the typed keys with the recording'''
+    records = load_session(path)
+    backend = VirtualTerminalBackend()
+    keyboard_manager, state_manager = create_managers(backend)
+    try:
+        start = perf_counter()
+        replayed = SessionReplayer(records).replay(state_manager, original_speed=not fast)
+        elapsed = perf_counter() - start
+        # Let the emitter finish what was queued
+        while keyboard_manager.queue_depth > 0:
+            sleep(0.01)
+    finally:
+        state_manager.stop()
+        keyboard_manager.stop()
+
+    recorded = keys_of_kind(records, EMITTED)
+    typed = [key for _, key in backend.keys]
+    divergence = next((i for i, (a, b) in enumerate(zip(recorded, typed)) if a != b), min(len(recorded), len(typed)))
+
+    print(f"Hooked keys:        {replayed} replayed in {elapsed:.2f}s ({'as fast as possible' if fast else 'original speed'})")
+    print(f"Typed keys:         {len(typed)} (recorded {len(recorded)})")
+    if divergence == len(recorded) == len(typed):
+        print("Typed keys match the recording")
+    else:
+        print(f"First difference:   key {divergence}")
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction*len(ordered)))]
+
+def benchmark_jitter(traps: int, load: int) -> None:
+    '''Per-key timing error of a key mode trap pass, with relative sleeps and with precise deadlines'''
+    # Busy threads competing for the GIL, like a loaded machine
+    loaded = True
+    def busy():
+        while loaded:
+            pass
+    load_threads = [threading.Thread(target=busy) for _ in range(load)]
+    for thread in load_threads:
+        thread.start()
+
+    try:
+        for precise in [False, True]:
+            backend = VirtualTerminalBackend()
+            keyboard_manager, state_manager = create_managers(backend)
+            keyboard_manager.precise_timing = precise
+            keyboard_manager.clock = KeyClock(precise)
+            try:
+                keys = [key for trap in state_manager.all_traps[:traps] for key in [*trap, 'enter']]
+                interval = keyboard_manager.key_wait_time()
+                state_manager.type_keys_and_wait(keys)
+                sleep(interval*2) # Let the last key be pressed
+            finally:
+                state_manager.stop()
+                keyboard_manager.stop()
+
+            pressed = [pressed_at for pressed_at, _ in backend.keys]
+            errors = [abs((pressed[i] - pressed[i - 1]) / 1e9 - interval) for i in range(1, len(pressed))]
+            drift = (pressed[-1] - pressed[0]) / 1e9 - interval*(len(pressed) - 1)
+            print(f"{'precise' if precise else 'sleep'} mode ({len(pressed)} keys, {interval * 1e3:.1f}ms apart)")
+            print(f"  p50 error:        {percentile(errors, 0.5) * 1e3:.3f}ms")
+            print(f"  p99 error:        {percentile(errors, 0.99) * 1e3:.3f}ms")
+            print(f"  total drift:      {drift * 1e3:.1f}ms")
+    finally:
+        loaded = False
+        for thread in load_threads:
+            thread.join()
+
+def benchmark_emitter(traps: int, players: int) -> None:
+    '''Per-key timing error of the emitter thread and the emitter process, while the UI re-renders non stop'''
+    for mode in ["thread", "process"]:
+        backend = VirtualTerminalBackend()
+        if mode == "thread":
+            keyboard_manager = KeyboardManager(logger, backend)
+        else:
+            keyboard_manager = ProcessKeyboardManager(logger, backend)
+        state_manager = TerminalStateManager(keyboard_manager, logger, traps_file="")
+
+        # Rebuild and print every frame from scratch, holding the GIL as much as rich does
+        terminal_ui = TerminalUI(state_manager)
+        terminal_ui.console = Console(file=io.StringIO(), width=120)
+        terminal_ui.players = [f"player{i + 1}" for i in range(players)]
+        terminal_ui.radars = [f"radar{i + 1}" for i in range(players)]
+        rendering = True
+        frames = 0
+        def render_load():
+            nonlocal frames
+            while rendering:
+                terminal_ui.regions.clear()
+                terminal_ui.tables_cache.clear()
+                terminal_ui.update_regions()
+                terminal_ui.console.print(terminal_ui.build_frame())
+                terminal_ui.console.file.seek(0)
+                terminal_ui.console.file.truncate()
+                frames += 1
+        render_thread = threading.Thread(target=render_load)
+        render_thread.start()
+
+        try:
+            keys = [key for trap in state_manager.all_traps[:traps] for key in [*trap, 'enter']]
+            # Everything is queued at once, the spacing of the keys only depends on the emitter
+            keyboard_manager.press_keys(keys).wait()
+        finally:
+            rendering = False
+            render_thread.join()
+            state_manager.stop()
+            keyboard_manager.stop()
+
+        interval = keyboard_manager.config.get("BATCH_KEY_DELAY") + keyboard_manager.config.get("BATCH_INTER_KEY_DELAY")
+        pressed = [pressed_at for pressed_at, key in backend.keys]
+        errors = [abs((pressed[i] - pressed[i - 1]) / 1e9 - interval) for i in range(1, len(pressed)) if backend.keys[i - 1][1] != 'enter']
+        print(f"{mode} emitter ({len(pressed)} keys, {interval * 1e3:.1f}ms apart, {frames} frames rendered)")
+        print(f"  p50 error:        {percentile(errors, 0.5) * 1e3:.3f}ms")
+        print(f"  p99 error:        {percentile(errors, 0.99) * 1e3:.3f}ms")
+        print(f"  max error:        {max(errors) * 1e3:.3f}ms")
+
+def benchmark_control(requests: int) -> None:
+    '''Round trip of the control server, and what its commands typed into the terminal'''
+    backend = VirtualTerminalBackend()
+    keyboard_manager, state_manager = create_managers(backend)
+    server = ControlServer(state_manager, logger, 0, token="benchmark")
+    server.start()
+    client = ControlClient(server.port, token="benchmark")
+    try:
+        # The terminal is not open yet
+        refused = client.send({"command": "ping_radar", "radar": 1})[0]
+
+        # Open the terminal and wait for 'view monitor'
+        type_user_keys(backend, ['t', 'enter'])
+        sleep(1.5)
+
+        round_trips = []
+        for _ in range(requests):
+            start = perf_counter()
+            client.send({"command": "status"})
+            round_trips.append(perf_counter() - start)
+
+        traps = "a0-a4 c*"
+        replies = client.send(
+            {"id": 1, "command": "add_traps", "traps": traps, "priority": 1},
+            {"id": 2, "command": "ping_radar", "radar": 2},
+            {"id": 3, "command": "switch", "player": "player3"},
+            {"id": 4, "command": "transmit", "text": "hello crew"},
+            {"id": 5, "command": "toggle_all_traps", "enabled": False},
+        )
+
+        # Streamed until a trap cycle typed the new traps
+        client.send({"command": "subscribe", "interval": 0.1})
+        cycles = None
+        streamed = 0
+        for status in client.stream():
+            streamed += 1
+            if cycles is None:
+                cycles = status["trap_cycles"]
+            if status["trap_cycles"] > cycles and not status["typing_traps"]:
+                break
+    finally:
+        client.close()
+        server.stop()
+        state_manager.stop()
+        keyboard_manager.stop()
+
+    lines = [line for _, line in backend.get_lines()]
+    expected = ["ping radar2", "switch player3", "transmit hello crew"]
+    typed_traps = [trap for trap in parse_trap_ranges(traps) if trap in lines]
+    print(f"Refused in gameplay: {not refused['ok']} ({refused.get('error')})")
+    print(f"Round trip p50:     {percentile(round_trips, 0.5) * 1e3:.3f}ms")
+    print(f"Round trip p99:     {percentile(round_trips, 0.99) * 1e3:.3f}ms")
+    print(f"Commands ok:        {sum(reply['ok'] for reply in replies)}/{len(replies)}")
+    print(f"Commands typed:     {sum(line in lines for line in expected)}/{len(expected)}")
+    print(f"Traps typed:        {len(typed_traps)}/{len(parse_trap_ranges(traps))}")
+    print(f"Statuses streamed:  {streamed}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Lethal Terminal benchmarks")
+    parser.add_argument("--config", help="Config file to benchmark, e.g. with another KEYBOARD_INPUT_DELAY")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    hook = benchmarks.add_parser("hook", help="Dropped keys across rapid state transitions")
+    hook.add_argument("--cycles", type=int, default=1000)
+
+    ui = benchmarks.add_parser("ui", help="Frame build time with and without the render cache")
+    ui.add_argument("--frames", type=int, default=200)
+    ui.add_argument("--players", type=int, default=32)
+    ui.add_argument("--radars", type=int, default=32)
+
+    session = benchmarks.add_parser("session", help="Realistic sessions into a simulated game terminal")
+    session.add_argument("--session", choices=["traps", "all", "interleaved"], default="traps")
+    session.add_argument("--duration", type=float, default=15)
+    session.add_argument("--min-key-interval", type=float, default=0.015,
+                         help="Keys closer together than this (in seconds) are lost by the terminal")
+    session.add_argument("--record", help="Record the session to this file")
+
+    jitter = benchmarks.add_parser("jitter", help="Per-key timing error with sleep and precise timing")
+    jitter.add_argument("--traps", type=int, default=260, help="Traps typed, 3 keys each")
+    jitter.add_argument("--load", type=int, default=0, help="Busy threads to run alongside")
+
+    emitter = benchmarks.add_parser("emitter", help="Per-key timing error of the emitter thread and process, under UI load")
+    emitter.add_argument("--traps", type=int, default=100, help="Traps typed, 3 keys each")
+    emitter.add_argument("--players", type=int, default=64, help="Players and radars in the re-rendered UI")
+
+    control = benchmarks.add_parser("control", help="Round trip of the control server and the commands it types")
+    control.add_argument("--requests", type=int, default=200, help="Status requests timed")
+
+    replay = benchmarks.add_parser("replay", help="Replay a recorded session and compare what was typed")
+    replay.add_argument("path")
+    replay.add_argument("--fast", action="store_true", help="As fast as possible, instead of the original speed")
+
+    args = parser.parse_args()
+    if args.config:
+        os.environ['CONFIG_FILE'] = args.config
+    match args.benchmark:
+        case "hook":
+            benchmark_hook(args.cycles)
+        case "ui":
+            benchmark_ui(args.frames, args.players, args.radars)
+        case "session":
+            benchmark_session(args.session, args.duration, args.min_key_interval, args.record)
+        case "jitter":
+            benchmark_jitter(args.traps, args.load)
+        case "emitter":
+            benchmark_emitter(args.traps, args.players)
+        case "control":
+            benchmark_control(args.requests)
+        case "replay":
+            benchmark_replay(args.path, args.fast)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+'''Send commands to a running Lethal Terminal through its control server (CONTROL_PORT in the config)
+
+python lethal_control.py '{"command": "ping_radar", "radar": 3}' '{"command": "switch", "player": "player2"}'
+python lethal_control.py --watch 0.5
+'''
+from src.config import ConfigSingleton
+from src.control_client import ControlClient
+import argparse
+import json
+
+def main():
+    parser = argparse.ArgumentParser(description="Lethal Terminal control client")
+    parser.add_argument("commands", nargs="*", help='Commands as JSON, e.g. {"command": "add_traps", "traps": "a0-a9"}, sent as one batch')
+    parser.add_argument("--port", type=int, help="The control server port, CONTROL_PORT of the config by default")
+    parser.add_argument("--token", help="The control token, CONTROL_TOKEN of the config by default")
+    parser.add_argument("--watch", type=float, metavar="INTERVAL", help="Then print the status every INTERVAL seconds")
+    args = parser.parse_args()
+
+    port = args.port if args.port else ConfigSingleton().snapshot.CONTROL_PORT
+    if not port:
+        parser.error("Set CONTROL_PORT in the config, or pass --port")
+
+    token = args.token if args.token is not None else ConfigSingleton().snapshot.CONTROL_TOKEN
+    client = ControlClient(port, token=token)
+    try:
+        if args.commands:
+            for reply in client.send(*[json.loads(command) for command in args.commands]):
+                print(json.dumps(reply))
+        if args.watch:
+            client.send({"command": "subscribe", "interval": args.watch})
+            client.socket.settimeout(None)
+            for status in client.stream():
+                print(json.dumps(status), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
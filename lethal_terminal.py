@@ -1,32 +1,119 @@
+from time import perf_counter
+# Taken before the other imports, so the startup profile includes them
+STARTED = perf_counter()
 from src.terminal_state_manager import TerminalStateManager
-from src.keyboard_manager import KeyboardManager
-from src.terminal_ui import TerminalUI
-from src.config import ConfigSingleton
+from src.keyboard_manager import create_keyboard_manager
+from src.headless_status import HeadlessStatus
+from src.config import ConfigSingleton, ConfigWatcher
+from src.output_backend import create_backend
+from src.session_recorder import SessionRecorder
+from src.delay_controller import calibrate, simulated_terminal_check, user_confirmed_check
+from src.log_writer import setup_logging, load_trace
+from datetime import datetime
+import argparse
 import logging
+import multiprocessing
+
+def run_calibration(mode: str, min_key_interval: float) -> None:
+    '''Find the fastest reliable KEYBOARD_INPUT_DELAY'''
+    if mode == "simulated":
+        check = simulated_terminal_check(min_key_interval)
+    else:
+        check = user_confirmed_check(create_backend())
+    delay = calibrate(check)
+    print(f"Fastest reliable KEYBOARD_INPUT_DELAY: {delay:.4f}, set it in config.json")
+
+def print_trace(path: str) -> None:
+    '''Print a binary trace written with TRACE_FILE'''
+    for timestamp, level, message in load_trace(path):
+        time = datetime.fromtimestamp(timestamp / 1e9).strftime("%H:%M:%S.%f")
+        print(f"{time} {logging.getLevelName(level):<8} {message}")
+
+# How long each step from launch to a usable hook and the first frame took
+class StartupProfile:
+    def __init__(self):
+        self.last = STARTED
+        self.steps = []
+
+    def mark(self, step: str) -> None:
+        now = perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def __str__(self) -> str:
+        steps = ", ".join(f"{step} {seconds*1000:.1f}ms" for step, seconds in self.steps)
+        return f"{steps}, total {(self.last - STARTED)*1000:.1f}ms"
 
 def main():
+    # The process emitter starts a child process, also from the packaged executable
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Lethal Terminal")
+    parser.add_argument("--calibrate", choices=["simulated", "user"],
+                        help="Find the fastest reliable KEYBOARD_INPUT_DELAY, against a simulated terminal or by confirming what was typed")
+    parser.add_argument("--min-key-interval", type=float, default=0.015,
+                        help="For --calibrate simulated, keys closer together than this (in seconds) are lost")
+    parser.add_argument("--read-trace", metavar="FILE", help="Print a binary trace written with TRACE_FILE")
+    parser.add_argument("--headless", action="store_true",
+                        help="No UI, only a plain text line when the state, the traps or the last event change")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print how long each startup step took once the hook and the first frame are ready, then exit")
+    args = parser.parse_args()
+    profile = StartupProfile()
+    profile.mark("imports")
+
+    if args.read_trace:
+        print_trace(args.read_trace)
+        return
+
     config = ConfigSingleton()
+    if args.calibrate:
+        run_calibration(args.calibrate, args.min_key_interval)
+        return
 
-    # Configure logging
-    file_handler = logging.FileHandler("lethal_terminal.log")
-    logging.basicConfig(
-        level=config.get("LOG_LEVEL"),
-        format="%(message)s",
-        handlers=[file_handler]
+    # Configure logging, records are written by a background thread
+    log_listener = setup_logging(
+        config.get("LOG_LEVEL"),
+        config.get("LOG_MAX_BYTES", 1048576),
+        config.get("LOG_BACKUP_COUNT", 3),
+        config.get("TRACE_FILE", ""),
     )
     logger = logging.getLogger("Lethal Terminal")
+    profile.mark("config and logging")
+
+    # Record the session, to replay it later
+    recorder = SessionRecorder(config.get("RECORD_SESSION")) if config.get("RECORD_SESSION") else None
 
     # Keyboard operations
-    keyboard_manager = KeyboardManager(logger)
+    keyboard_manager = create_keyboard_manager(logger, recorder=recorder)
+    profile.mark("emitter")
+
+    # Follow the changes of config.json while running
+    config_watcher = ConfigWatcher(logger)
+    config_watcher.start()
 
+    state_manager = None
+    terminal_ui = None
+    control_server = None
     try:
         # Initialize TerminalStateManager
         state_manager = TerminalStateManager(keyboard_manager, logger)
-        
-        # Initialize TerminalUI
-        terminal_ui = TerminalUI(state_manager)
+        profile.mark("hook ready")
+
+        # Commands from other tools, e.g. a stream deck
+        if config.snapshot.CONTROL_PORT:
+            from src.control_server import ControlServer
+            control_server = ControlServer(state_manager, logger, config.snapshot.CONTROL_PORT, config.snapshot.CONTROL_TOKEN)
+            control_server.start()
+
+        # Initialize the UI, rich is only imported when it is shown
+        if args.headless:
+            terminal_ui = HeadlessStatus(state_manager)
+        else:
+            from src.terminal_ui import TerminalUI
+            terminal_ui = TerminalUI(state_manager)
 
         # Register the refresh callback after both are created
+        # Only requests a frame, the UI renders on its own thread
         def refresh_ui_callback():
             terminal_ui.rerender()
 
@@ -35,12 +122,28 @@ def main():
 
         # Initial render of the UI
         terminal_ui.render()
+        profile.mark("first frame")
+        logger.info("Startup: %s", profile)
+        if args.profile_startup:
+            print(f"Startup: {profile}")
+            return
 
         # Keep the program alive
         keyboard_manager.wait()
     finally:
         # Stop the threads
+        config_watcher.stop()
+        if control_server:
+            control_server.stop()
+        if terminal_ui:
+            terminal_ui.stop()
+        if state_manager:
+            state_manager.stop()
         keyboard_manager.stop()
+        if recorder:
+            recorder.close()
+        log_listener.stop()
+        logging.shutdown()
 
 if __name__ == "__main__":
     main()
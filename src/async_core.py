@@ -0,0 +1,246 @@
+from concurrent.futures import Future
+from time import perf_counter_ns
+from logging import Logger
+from typing import Any, Awaitable, Callable, Optional, Tuple
+import asyncio
+import threading
+from .config import ConfigSingleton
+from .keyboard_manager import KeyboardManager
+from .output_backend import OutputBackend
+from .session_recorder import SessionRecorder, EMITTED
+
+# Everything of CORE_MODE asyncio lives here, so asyncio is only imported when that mode is used
+
+# A KeyClock for the asyncio core, waits on the event loop clock without blocking the loop.
+# In precise mode the waits end on absolute deadlines, the loop timers replace the spinning
+class AsyncKeyClock:
+    def __init__(self, loop, precise: bool):
+        self.loop = loop
+        self.precise = precise
+        self.deadline = loop.time()
+
+    def start(self) -> None:
+        '''The next wait is measured from now'''
+        self.deadline = self.loop.time()
+
+    async def wait(self, seconds: float) -> None:
+        if not self.precise:
+            await asyncio.sleep(seconds)
+            return
+
+        now = self.loop.time()
+        if now - self.deadline > seconds:
+            self.deadline = now
+        self.deadline += seconds
+        await asyncio.sleep(max(0.0, self.deadline - now))
+
+# One asyncio event loop, on its own thread, that owns the state machine, the trap timer and the key emission
+#
+# Other threads (the keyboard hook, the UI, shutdown) hand work to it with call() and run(),
+# so the buffers and flags of the state machine are only ever touched by the loop thread
+class AsyncCore:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop, daemon=True)
+        self.thread.start()
+
+    def run_loop(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        # Let the tasks that are left finish their cancellation
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def in_loop(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    def call(self, func: Callable, *args) -> None:
+        '''Run func on the loop, without waiting for it'''
+        if self.in_loop():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def run(self, func: Callable, *args) -> Any:
+        '''Run func on the loop and wait for its result'''
+        if self.in_loop():
+            return func(*args)
+        future = Future()
+        def run_func():
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        self.loop.call_soon_threadsafe(run_func)
+        return future.result()
+
+    def clock(self, precise: bool) -> AsyncKeyClock:
+        '''A new clock on the loop, to pace a run of keys'''
+        return AsyncKeyClock(self.loop, precise)
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+# The emitter as a task of the AsyncCore loop instead of a thread
+#
+# enqueue returns an asyncio future that is done once the keys are typed. It is called from the loop,
+# where the state machine runs. Keys are paced on the loop clock
+class AsyncKeyboardManager(KeyboardManager):
+    def __init__(self, logger: Logger, core: AsyncCore, backend: Optional[OutputBackend] = None,
+                 recorder: Optional[SessionRecorder] = None):
+        self.async_core = core
+        super().__init__(logger, backend, recorder)
+        self.core = core
+
+    def start(self) -> None:
+        self.clock = self.async_core.clock(self.precise_timing)
+        self.async_core.run(self.start_emitter)
+
+    def start_emitter(self) -> None:
+        self.key_ready = asyncio.Event()
+        self.task = self.async_core.loop.create_task(self.process_keys_async())
+
+    async def process_keys_async(self) -> None:
+        while self.running:
+            if len(self.queue) == 0:
+                self.key_ready.clear()
+                await self.key_ready.wait()
+                continue
+            with self.lock:
+                keys, batched, done = self.take_unit()
+            self.logger.debug("Typing %s", keys)
+
+            self.clock.start()
+            if batched:
+                await self.type_batch_async(keys)
+            else:
+                for key in keys:
+                    delay = self.key_delay()
+                    started = self.async_core.loop.time()
+                    self.backend.press(key)
+                    try:
+                        await self.clock.wait(delay)
+                    finally:
+                        # Never leave a key held down when cancelled
+                        self.backend.release(key)
+                    if self.delay_controller:
+                        self.delay_controller.record_key(delay, self.async_core.loop.time() - started, self.pending_keys)
+
+            if not done.done():
+                done.set_result(None)
+
+    async def type_batch_async(self, keys: Tuple[str, ...]) -> None:
+        '''Type a whole sequence with the batch timing profile'''
+        for key in keys:
+            # A reloaded config applies from the next key
+            config = self.config.snapshot
+            self.backend.press(key)
+            try:
+                await self.clock.wait(config.BATCH_KEY_DELAY)
+            finally:
+                self.backend.release(key)
+            # Give the game time to process a submitted line
+            await self.clock.wait(config.BATCH_LINE_DELAY if key == 'enter' else config.BATCH_INTER_KEY_DELAY)
+
+    def enqueue(self, keys: Tuple[str, ...], batched: bool) -> asyncio.Future:
+        if not self.async_core.in_loop():
+            return self.async_core.run(self.enqueue, keys, batched)
+        if self.recorder:
+            for key in keys:
+                self.recorder.record(EMITTED, key)
+        done = self.async_core.loop.create_future()
+        hooked_at = self.metrics.origin()
+        with self.lock:
+            self.queue.append((keys, batched, perf_counter_ns(), hooked_at, done))
+            self.pending_keys += len(keys)
+            self.max_queue_depth = max(self.max_queue_depth, self.pending_keys)
+        self.key_ready.set()
+        return done
+
+    def stop(self) -> None:
+        self.async_core.run(self.stop_emitter)
+        self.async_core.stop()
+
+    def stop_emitter(self) -> None:
+        with self.lock:
+            self.running = False
+            # Release anyone waiting on keys that will never be typed
+            for _, _, _, _, done in self.queue:
+                if not done.done():
+                    done.set_result(None)
+            self.queue.clear()
+            self.pending_keys = 0
+        self.task.cancel()
+
+# The TrapWriter of the asyncio core, a task on the loop instead of a thread
+#
+# Same scheduling: deadlines on the loop clock, a cycle that overruns its slot starts the next one right away.
+# A pause lets the running cycle finish, like the thread does
+class AsyncTrapWriter:
+    def __init__(self, cycle: Callable[[], Awaitable[None]], logger: Logger, core):
+        self.cycle = cycle # Types one round of traps
+        self.logger = logger
+        self.config = ConfigSingleton()
+        self.core = core # The AsyncCore running the loop
+
+        self.task = None
+        self.paused = True
+        self.in_cycle = False
+        self.next_deadline = None # When the next cycle starts, loop time in seconds
+
+    async def run(self) -> None:
+        loop = self.core.loop
+        while not self.paused:
+            await asyncio.sleep(max(0.0, self.next_deadline - loop.time()))
+            cycle_start = self.next_deadline
+
+            self.in_cycle = True
+            try:
+                await self.cycle()
+            finally:
+                self.in_cycle = False
+
+            if self.paused:
+                return
+            # Resumed during the cycle, the deadline was reset
+            if self.next_deadline != cycle_start:
+                continue
+            self.next_deadline = cycle_start + self.config.snapshot.TRAP_TIMER_DURATION
+            now = loop.time()
+            if self.next_deadline < now:
+                self.logger.debug("Trap cycle overran by %.3fs", now - self.next_deadline)
+                self.next_deadline = now
+
+    def resume(self, delay: float = 0) -> None:
+        '''Start the cycles again, the first one after the delay'''
+        self.core.call(self.resume_in_loop, delay)
+
+    def resume_in_loop(self, delay: float) -> None:
+        if not self.paused:
+            return
+        self.paused = False
+        self.next_deadline = self.core.loop.time() + delay
+        if self.task is None or self.task.done():
+            self.task = self.core.loop.create_task(self.run())
+
+    def pause(self) -> None:
+        self.core.call(self.pause_in_loop)
+
+    def pause_in_loop(self) -> None:
+        self.paused = True
+        self.next_deadline = None
+        # Waiting for the next cycle, a running cycle is left to finish
+        if self.task is not None and not self.in_cycle:
+            self.task.cancel()
+            self.task = None
+
+    def stop(self) -> None:
+        def cancel():
+            self.paused = True
+            if self.task is not None:
+                self.task.cancel()
+        self.core.run(cancel)
@@ -0,0 +1,175 @@
+from collections import deque
+from time import perf_counter_ns
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+import threading
+
+# Kinds of commands, also their priority class: a lower kind is typed first
+SYSTEM = 0 # A macro, e.g. view monitor, switch or ping
+USER_LINE = 1 # A line the user finished while traps were typed
+TRAP_REFRESH = 2 # A trap and enter
+KINDS = [SYSTEM, USER_LINE, TRAP_REFRESH]
+KIND_NAMES = {SYSTEM: "system", USER_LINE: "user_line", TRAP_REFRESH: "trap_refresh"}
+
+# Keys waiting to be typed as one unit
+class Command():
+    def __init__(self, kind: int, keys: Tuple[str, ...], dedupe_key: Optional[Hashable] = None):
+        self.kind = kind
+        self.keys = keys
+        self.dedupe_key = dedupe_key # Commands with the same kind and key are only queued once
+        self.enqueued_at = perf_counter_ns()
+
+# The commands the trap writer types, shared by the hook thread and the trap writer
+#
+# One deque per priority class behind a single short lock, every operation is O(1) per command.
+# A command already pending with the same dedupe key is not queued twice
+class CommandQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {kind: deque() for kind in KINDS}
+        self.pending = set() # (kind, dedupe key) of the queued commands
+
+        # Stats
+        self.contended = 0 # Times the lock was already taken
+        self.pushed = {kind: 0 for kind in KINDS}
+        self.duplicates = {kind: 0 for kind in KINDS}
+        self.cancelled = {kind: 0 for kind in KINDS}
+        self.popped = {kind: 0 for kind in KINDS}
+        self.total_wait = {kind: 0 for kind in KINDS} # Nanoseconds
+        self.max_wait = {kind: 0 for kind in KINDS}
+
+    def acquire(self) -> None:
+        if not self.lock.acquire(blocking=False):
+            self.contended += 1
+            self.lock.acquire()
+
+    def push(self, kind: int, keys: Iterable[str], dedupe_key: Optional[Hashable] = None) -> bool:
+        '''Queue a command, returns False when the same command is already pending'''
+        command = Command(kind, tuple(keys), dedupe_key)
+        self.acquire()
+        try:
+            if dedupe_key is not None:
+                if (kind, dedupe_key) in self.pending:
+                    self.duplicates[kind] += 1
+                    return False
+                self.pending.add((kind, dedupe_key))
+            self.queues[kind].append(command)
+            self.pushed[kind] += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def take(self, command: Command) -> Command:
+        '''Count a command leaving the queue, must be called while holding the lock'''
+        if command.dedupe_key is not None:
+            self.pending.discard((command.kind, command.dedupe_key))
+        wait = perf_counter_ns() - command.enqueued_at
+        self.popped[command.kind] += 1
+        self.total_wait[command.kind] += wait
+        self.max_wait[command.kind] = max(self.max_wait[command.kind], wait)
+        return command
+
+    def pop(self, kinds: Iterable[int] = KINDS) -> Optional[Command]:
+        '''The oldest command of the highest priority class among kinds, None when they are empty'''
+        self.acquire()
+        try:
+            for kind in sorted(kinds):
+                if len(self.queues[kind]) > 0:
+                    return self.take(self.queues[kind].popleft())
+            return None
+        finally:
+            self.lock.release()
+
+    def pop_group(self, kind: int, max_keys: int) -> List[Command]:
+        '''As many commands of a kind as fit in max_keys keys, at least one when there is one'''
+        group = []
+        keys = 0
+        self.acquire()
+        try:
+            queue = self.queues[kind]
+            while len(queue) > 0:
+                if len(group) > 0 and keys + len(queue[0].keys) > max_keys:
+                    break
+                command = self.take(queue.popleft())
+                group.append(command)
+                keys += len(command.keys)
+            return group
+        finally:
+            self.lock.release()
+
+    def cancel(self, kinds: Iterable[int] = KINDS) -> int:
+        '''Drop the pending commands of these kinds, returns how many were dropped'''
+        dropped = 0
+        self.acquire()
+        try:
+            for kind in kinds:
+                for command in self.queues[kind]:
+                    if command.dedupe_key is not None:
+                        self.pending.discard((kind, command.dedupe_key))
+                self.cancelled[kind] += len(self.queues[kind])
+                dropped += len(self.queues[kind])
+                self.queues[kind].clear()
+            return dropped
+        finally:
+            self.lock.release()
+
+    def count(self, kind: int) -> int:
+        return len(self.queues[kind])
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def get_stats(self) -> Dict[str, dict]:
+        '''Snapshot of the queue counters, waits in milliseconds'''
+        self.acquire()
+        try:
+            stats = {"contended": self.contended}
+            for kind in KINDS:
+                popped = self.popped[kind]
+                stats[KIND_NAMES[kind]] = {
+                    "pending": len(self.queues[kind]),
+                    "pushed": self.pushed[kind],
+                    "duplicates": self.duplicates[kind],
+                    "cancelled": self.cancelled[kind],
+                    "average_wait": self.total_wait[kind] / popped / 1e6 if popped > 0 else 0.0,
+                    "max_wait": self.max_wait[kind] / 1e6,
+                }
+            return stats
+        finally:
+            self.lock.release()
+
+# The line the user is typing, kept to retype it after the traps. Edited by the hook thread, read by the trap writer
+class PendingLine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = []
+
+    def append(self, key: str) -> None:
+        with self.lock:
+            self.keys.append(key)
+
+    def pop(self) -> None:
+        '''Remove the last key, if there is one'''
+        with self.lock:
+            if len(self.keys) > 0:
+                self.keys.pop()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.keys.clear()
+
+    def snapshot(self) -> Tuple[str, ...]:
+        with self.lock:
+            return tuple(self.keys)
+
+    def take(self) -> Tuple[str, ...]:
+        '''The keys of the line, leaving it empty'''
+        with self.lock:
+            keys = tuple(self.keys)
+            self.keys.clear()
+            return keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.snapshot())
@@ -1,11 +1,125 @@
+from logging import Logger
+from types import MappingProxyType
+from typing import Any, Callable, List, Mapping, NamedTuple, Optional, Tuple
 import json
 import os
-from typing import Optional, Any
+import threading
+
+# The config, parsed and checked once. Every key of config.json is an attribute, read with a plain attribute lookup
+# on hot paths: ConfigSingleton().snapshot.KEYBOARD_INPUT_DELAY. A reload swaps in a new snapshot, it never changes one
+class ConfigSnapshot(NamedTuple):
+    OUTPUT_BACKEND: str = "keyboard"
+    CORE_MODE: str = "threads"
+    EMITTER_MODE: str = "thread"
+    KEYBOARD_INPUT_DELAY: float = 0.020
+    TIMING_MODE: str = "sleep"
+    ADAPTIVE_DELAY: bool = False
+    MIN_KEYBOARD_INPUT_DELAY: float = 0.005
+    MAX_KEYBOARD_INPUT_DELAY: float = 0.050
+    EMISSION_MODE: str = "key"
+    BATCH_KEY_DELAY: float = 0.010
+    BATCH_INTER_KEY_DELAY: float = 0.005
+    BATCH_LINE_DELAY: float = 0.030
+    TRAP_TIMER_DURATION: float = 5
+    TRAP_CYCLE_BUDGET: float = 0.8
+    MAX_USER_LINE_WAIT: float = 0.1
+    DEFAULT_TRAP_PRIORITY: int = 1
+    TRAPS_FILE: str = "lethal_terminal_traps.bin"
+    TRAP_SETTINGS: Mapping = MappingProxyType({})
+    LOG_LEVEL: int = 20
+    LOG_MAX_BYTES: int = 1048576
+    LOG_BACKUP_COUNT: int = 3
+    TRACE_FILE: str = ""
+    RECORD_SESSION: str = ""
+    UI_MAX_FPS: float = 30
+    SHOW_METRICS: bool = False
+    METRICS_FILE: str = "lethal_terminal_metrics.json"
+    CONFIG_RELOAD_INTERVAL: float = 1.0
+    CONTROL_PORT: int = 0
+    CONTROL_TOKEN: str = ""
+    KEY_BINDINGS: Mapping = MappingProxyType({})
+    MACROS: Mapping = MappingProxyType({})
+    PLAYERS: Tuple[str, ...] = ("player1", "player2", "player3", "player4")
+    RADARS: Tuple[str, ...] = ("radar1", "radar2", "radar3", "radar4")
+
+# The allowed values of the mode keys
+CHOICES = {
+    "OUTPUT_BACKEND": ("keyboard", "virtual"),
+    "CORE_MODE": ("threads", "asyncio"),
+    "EMITTER_MODE": ("thread", "process"),
+    "TIMING_MODE": ("sleep", "precise"),
+    "EMISSION_MODE": ("key", "batch"),
+}
+# Keys read once at startup, a reload only warns that they changed
+RESTART_KEYS = ("OUTPUT_BACKEND", "CORE_MODE", "EMITTER_MODE", "TIMING_MODE", "ADAPTIVE_DELAY", "TRAPS_FILE",
+                "LOG_LEVEL", "LOG_MAX_BYTES", "LOG_BACKUP_COUNT", "TRACE_FILE", "RECORD_SESSION", "SHOW_METRICS",
+                "CONFIG_RELOAD_INTERVAL", "CONTROL_PORT", "CONTROL_TOKEN")
+# Keys that are divided by or waited on, 0 would stop the trap writer or the UI
+POSITIVE_KEYS = ("KEYBOARD_INPUT_DELAY", "MIN_KEYBOARD_INPUT_DELAY", "TRAP_TIMER_DURATION", "UI_MAX_FPS")
+# The control server only listens on this machine
+CONTROL_HOST = "127.0.0.1"
+
+def parse_value(key: str, value: Any, value_type: Any) -> Any:
+    '''The value of a config key as its type, raises ValueError when it does not fit'''
+    if value_type is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+        if value < 0:
+            raise ValueError(f"{key} cannot be negative")
+        return float(value)
+    if value_type is int and isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if value_type is bool and isinstance(value, bool):
+        return value
+    if value_type is str and isinstance(value, str):
+        if key in CHOICES and value not in CHOICES[key]:
+            raise ValueError(f"{key} should be one of {', '.join(CHOICES[key])}, not '{value}'")
+        return value
+    if value_type is Mapping and isinstance(value, dict):
+        return MappingProxyType(value)
+    if value_type == Tuple[str, ...] and isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return tuple(value)
+    raise ValueError(f"{key} has the wrong type: {value!r}")
+
+def parse_config(values: dict) -> ConfigSnapshot:
+    '''Check the values of a config file, the keys it does not set keep their default'''
+    if not isinstance(values, dict):
+        raise ValueError("The config should be a JSON object")
+    fields = ConfigSnapshot.__annotations__
+    snapshot = ConfigSnapshot(**{key: parse_value(key, value, fields[key]) for key, value in values.items() if key in fields})
+    if snapshot.MIN_KEYBOARD_INPUT_DELAY > snapshot.MAX_KEYBOARD_INPUT_DELAY:
+        raise ValueError("MIN_KEYBOARD_INPUT_DELAY is above MAX_KEYBOARD_INPUT_DELAY")
+    for key in POSITIVE_KEYS:
+        if getattr(snapshot, key) <= 0:
+            raise ValueError(f"{key} must be above 0")
+    if snapshot.DEFAULT_TRAP_PRIORITY < 1:
+        raise ValueError("DEFAULT_TRAP_PRIORITY must be at least 1")
+    check_tables(snapshot)
+    return snapshot
+
+def check_tables(snapshot: ConfigSnapshot) -> None:
+    '''Check the entries of TRAP_SETTINGS, KEY_BINDINGS and MACROS, a bad entry refuses the whole config'''
+    for trap, values in snapshot.TRAP_SETTINGS.items():
+        if not isinstance(values, dict):
+            raise ValueError(f"TRAP_SETTINGS of {trap} should be an object")
+        priority = values.get("PRIORITY", 1)
+        if not isinstance(priority, int) or isinstance(priority, bool) or priority < 1:
+            raise ValueError(f"PRIORITY of {trap} should be a whole number from 1, not {priority!r}")
+        interval = values.get("MIN_REFRESH_INTERVAL", 0)
+        if not isinstance(interval, (int, float)) or isinstance(interval, bool) or interval < 0:
+            raise ValueError(f"MIN_REFRESH_INTERVAL of {trap} should be a number of seconds, not {interval!r}")
+    for state, bindings in snapshot.KEY_BINDINGS.items():
+        if not isinstance(bindings, dict) or not all(isinstance(sequence, str) and isinstance(action, str) for sequence, action in bindings.items()):
+            raise ValueError(f"KEY_BINDINGS of {state} should map key sequences to action names")
+    for name, template in snapshot.MACROS.items():
+        if not isinstance(template, str) or template.strip() == "":
+            raise ValueError(f"Macro '{name}' needs a non empty text template")
+
+def read_config(config_file: str) -> ConfigSnapshot:
+    with open(config_file, 'r') as f:
+        return parse_config(json.load(f))
 
 # A class for reading from the JSON
 class ConfigSingleton:
     _instance = None
-    _config = None
 
     def __new__(cls, config_file: str = None):
         if cls._instance is None:
@@ -16,14 +130,74 @@ class ConfigSingleton:
     def _load_config(self, config_file: Optional[str]):
         if config_file is None:
             config_file = os.environ.get('CONFIG_FILE', 'config.json')
-        
+
         if not os.path.exists(config_file):
             raise FileNotFoundError(f"Config file '{config_file}' not found")
-        
-        with open(config_file, 'r') as f:
-            self._config = json.load(f)
+
+        self.config_file = config_file
+        self.mtime = os.stat(config_file).st_mtime_ns
+        self.snapshot = read_config(config_file)
+        self.version = 0 # Changes on every reload
+        self.listeners: List[Callable[[ConfigSnapshot], None]] = []
 
     def get(self, key: str, default: Any = None) -> Any:
-        return self._config.get(key, default)
+        '''The value of a key, hot paths read the attribute of snapshot instead'''
+        return getattr(self.snapshot, key, default)
+
+    def reload(self) -> bool:
+        '''Read the config file again if it changed since the last read, returns whether a new snapshot was swapped in.
+
+        Raises OSError or ValueError when the file cannot be read or is not valid, the current snapshot stays'''
+        mtime = os.stat(self.config_file).st_mtime_ns
+        if mtime == self.mtime:
+            return False
+        # Not read again until it changes again, even when it is not valid
+        self.mtime = mtime
+        self.snapshot = read_config(self.config_file)
+        self.version += 1
+        for listener in list(self.listeners):
+            listener(self.snapshot)
+        return True
+
+    def subscribe(self, listener: Callable[[ConfigSnapshot], None]) -> None:
+        '''Call listener with every new snapshot, from the thread that reloads the config'''
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[ConfigSnapshot], None]) -> None:
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+# Reloads the config when its file changes, by polling its mtime every CONFIG_RELOAD_INTERVAL (same on every OS)
+class ConfigWatcher:
+    def __init__(self, logger: Logger):
+        self.config = ConfigSingleton()
+        self.logger = logger
+        self.interval = self.config.snapshot.CONFIG_RELOAD_INTERVAL
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self.thread.start()
 
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            old = self.config.snapshot
+            try:
+                if not self.config.reload():
+                    continue
+            except (OSError, ValueError) as e:
+                self.logger.error("Kept the previous config, %s is not valid: %s", self.config.config_file, e)
+                continue
+            except Exception:
+                self.logger.exception("Failed to apply the new config")
+                continue
+            self.logger.info("Reloaded %s", self.config.config_file)
+            for key in RESTART_KEYS:
+                if getattr(old, key) != getattr(self.config.snapshot, key):
+                    self.logger.warning("%s changes after a restart", key)
 
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
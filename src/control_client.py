@@ -0,0 +1,48 @@
+from collections import deque
+from typing import Iterator, List
+import json
+import socket
+from .config import CONTROL_HOST
+
+# Talks to the control server: sends commands and reads their replies, the streamed status is kept apart
+class ControlClient:
+    def __init__(self, port: int, timeout: float = 5.0, token: str = ""):
+        self.token = token # Added to every command, the CONTROL_TOKEN of the server
+        self.socket = socket.create_connection((CONTROL_HOST, port), timeout=timeout)
+        self.file = self.socket.makefile("rwb")
+        self.streamed = deque() # Status messages read while waiting for a reply
+
+    def read(self) -> dict:
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("The control server closed the connection")
+        return json.loads(line)
+
+    def send(self, *commands: dict) -> List[dict]:
+        '''Send the commands as one batch, returns their replies in order'''
+        if self.token:
+            commands = tuple({**command, "token": self.token} for command in commands)
+        batch = commands[0] if len(commands) == 1 else list(commands)
+        self.file.write((json.dumps(batch) + "\n").encode())
+        self.file.flush()
+        replies = []
+        while len(replies) < len(commands):
+            message = self.read()
+            if "stream" in message:
+                self.streamed.append(message)
+            else:
+                replies.append(message)
+        return replies
+
+    def stream(self) -> Iterator[dict]:
+        '''The streamed status messages, after a subscribe'''
+        while True:
+            while len(self.streamed) > 0:
+                yield self.streamed.popleft()
+            message = self.read()
+            if "stream" in message:
+                yield message
+
+    def close(self) -> None:
+        self.file.close()
+        self.socket.close()
@@ -0,0 +1,252 @@
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from logging import Logger
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import hmac
+import json
+import threading
+from .config import CONTROL_HOST
+from .macros import text_to_keys
+from .traps import parse_trap_ranges
+from .terminal_state_manager import TerminalStateManager, State
+
+MAX_REQUEST_BYTES = 65536
+MIN_STREAM_INTERVAL = 0.05
+
+# A command that cannot be run, its message is sent back as the error
+class ControlError(Exception):
+    pass
+
+# The commands of the control server, run where the keys are handled so they never race the keyboard hook.
+# A command gets the request and returns what is added to its reply
+class ControlCommands:
+    def __init__(self, state_manager: TerminalStateManager, logger: Logger):
+        self.state_manager = state_manager
+        self.logger = logger
+        self.commands: Dict[str, Callable[[dict], Optional[dict]]] = {
+            "add_traps": self.add_traps,
+            "remove_traps": self.remove_traps,
+            "toggle_all_traps": self.toggle_all_traps,
+            "ping_radar": self.ping_radar,
+            "flash_radar": self.flash_radar,
+            "switch": self.switch,
+            "view_monitor": self.view_monitor,
+            "transmit": self.transmit,
+            "macro": self.macro,
+            "status": self.status,
+        }
+
+    def run(self, request: Any) -> dict:
+        '''Run one request, the reply has its id and either ok or the error'''
+        request_id = request.get("id") if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict):
+                raise ControlError("A command should be a JSON object")
+            command = self.commands.get(request.get("command"))
+            if command is None:
+                raise ControlError(f"Unknown command: {request.get('command')!r}")
+            result = self.state_manager.run_control(command, request) or {}
+        except ControlError as e:
+            return {"id": request_id, "ok": False, "error": str(e)}
+        except Exception:
+            self.logger.exception("Control command %s failed", request.get("command"))
+            return {"id": request_id, "ok": False, "error": "Internal error, see lethal_terminal.log"}
+        if self.state_manager.refresh_callback:
+            self.state_manager.refresh_callback()
+        return {"id": request_id, "ok": True, **result}
+
+    def parse_traps(self, request: dict) -> List[str]:
+        '''The traps of a request, a bulk entry (a0-a9 c*) or a list of them'''
+        spec = request.get("traps")
+        if isinstance(spec, list) and all(isinstance(item, str) for item in spec):
+            spec = ' '.join(spec)
+        traps = parse_trap_ranges(spec.lower()) if isinstance(spec, str) else None
+        if not traps:
+            raise ControlError(f"Not valid traps: {spec!r}")
+        return traps
+
+    def add_traps(self, request: dict) -> dict:
+        traps = self.parse_traps(request)
+        priority = request.get("priority")
+        if priority is not None and (not isinstance(priority, int) or isinstance(priority, bool) or priority < 1):
+            raise ControlError(f"Not a valid priority: {priority!r}")
+        added = self.state_manager.add_traps(traps, priority)
+        # Typed by the next cycle
+        self.state_manager.set_event(f"Added {len(added)} traps from the control server")
+        return {"added": added}
+
+    def remove_traps(self, request: dict) -> dict:
+        removed = self.state_manager.remove_traps(self.parse_traps(request))
+        self.state_manager.set_event(f"Removed {len(removed)} traps from the control server")
+        return {"removed": removed}
+
+    def toggle_all_traps(self, request: dict) -> dict:
+        '''Flips ALL TRAPS, or sets it when the request has enabled. Stays in the current state, typing only starts in the terminal'''
+        enabled = request.get("enabled")
+        if enabled is not None and not isinstance(enabled, bool):
+            raise ControlError(f"Not a valid enabled: {enabled!r}")
+        self.state_manager.set_all_traps(not self.state_manager.want_all_traps if enabled is None else enabled)
+        return {"all_traps": self.state_manager.want_all_traps}
+
+    def require_terminal(self) -> None:
+        '''Commands that type need the game terminal to be open, and no line the user is halfway through:
+        the enter a macro starts with would send it'''
+        if self.state_manager.state == State.GAMEPLAY:
+            raise ControlError("The terminal is not open")
+        if len(self.state_manager.to_be_written) > 0:
+            raise ControlError("A line is being typed, try again once it is sent")
+
+    def target_index(self, value: Any, names: Sequence[str], target: str) -> int:
+        '''The index of a player or radar, given by its number (from 1) or its name'''
+        if isinstance(value, int) and not isinstance(value, bool) and 1 <= value <= len(names):
+            return value - 1
+        if isinstance(value, str) and value in names:
+            return names.index(value)
+        raise ControlError(f"No {target}: {value!r}")
+
+    def run_macro(self, name: str, index: int = 0, suffix: Sequence[str] = ()) -> None:
+        self.require_terminal()
+        if not self.state_manager.run_macro(name, index, suffix):
+            raise ControlError(f"Cannot type {name}")
+
+    def ping_radar(self, request: dict) -> None:
+        self.run_macro("ping_radar", self.target_index(request.get("radar"), self.state_manager.config.snapshot.RADARS, "radar"))
+
+    def flash_radar(self, request: dict) -> None:
+        self.run_macro("flash_radar", self.target_index(request.get("radar"), self.state_manager.config.snapshot.RADARS, "radar"))
+
+    def switch(self, request: dict) -> None:
+        '''Switch to a player, or to the next one without a player'''
+        if request.get("player") is None:
+            self.run_macro("switch")
+        else:
+            self.run_macro("switch_player", self.target_index(request.get("player"), self.state_manager.config.snapshot.PLAYERS, "player"))
+
+    def view_monitor(self, request: dict) -> None:
+        self.run_macro("view_monitor")
+
+    def transmit(self, request: dict) -> None:
+        text = request.get("text")
+        if not isinstance(text, str) or text.strip() == "":
+            raise ControlError("transmit needs a text")
+        self.run_macro("transmit", suffix=(*text_to_keys(text), 'enter'))
+
+    def macro(self, request: dict) -> None:
+        '''Any macro, with the number of its player or radar as target'''
+        name = request.get("name")
+        if name not in self.state_manager.macros:
+            raise ControlError(f"Unknown macro: {name!r}")
+        target = request.get("target", 1)
+        if not isinstance(target, int) or isinstance(target, bool):
+            raise ControlError(f"Not a valid target: {target!r}")
+        self.run_macro(name, target - 1)
+
+    def status(self, request: dict) -> dict:
+        return self.state_manager.status()
+
+# One client of the control server: JSON lines in, one reply line per command out.
+# A line holds a command or a list of commands. subscribe streams the status every interval, until unsubscribe
+class ControlHandler(StreamRequestHandler):
+    def setup(self) -> None:
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.stream_stopped = threading.Event()
+        self.stream_thread = None
+
+    def handle(self) -> None:
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_BYTES)
+            if not line:
+                return
+            if line.strip() == b"":
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                # Not a control client, e.g. an HTTP request sent by a web page: never read what follows
+                self.send({"id": None, "ok": False, "error": "Not valid JSON"})
+                return
+            for command in request if isinstance(request, list) else [request]:
+                if not self.send(self.run(command)):
+                    return
+
+    def run(self, request: Any) -> dict:
+        if not self.server.authorized(request):
+            return {"id": request.get("id") if isinstance(request, dict) else None, "ok": False, "error": "Not a valid token"}
+        command = request.get("command") if isinstance(request, dict) else None
+        if command == "subscribe":
+            return self.subscribe(request)
+        if command == "unsubscribe":
+            self.stop_stream()
+            return {"id": request.get("id"), "ok": True}
+        return self.server.commands.run(request)
+
+    def subscribe(self, request: dict) -> dict:
+        interval = request.get("interval", 1.0)
+        if not isinstance(interval, (int, float)) or interval < MIN_STREAM_INTERVAL:
+            return {"id": request.get("id"), "ok": False, "error": f"The interval should be at least {MIN_STREAM_INTERVAL}s"}
+        self.stop_stream()
+        self.stream_stopped.clear()
+        self.stream_thread = threading.Thread(target=self.stream_status, args=(interval,), daemon=True)
+        self.stream_thread.start()
+        return {"id": request.get("id"), "ok": True}
+
+    def stream_status(self, interval: float) -> None:
+        # Only reads the state, it does not need to wait for the keys
+        while self.send({"stream": "status", **self.server.commands.state_manager.status()}):
+            if self.stream_stopped.wait(interval):
+                return
+
+    def stop_stream(self) -> None:
+        self.stream_stopped.set()
+        if self.stream_thread and self.stream_thread is not threading.current_thread():
+            self.stream_thread.join()
+        self.stream_thread = None
+
+    def send(self, message: dict) -> bool:
+        '''Returns False once the client is gone'''
+        data = (json.dumps(message) + "\n").encode()
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+                return True
+            except OSError:
+                return False
+
+    def finish(self) -> None:
+        self.stop_stream()
+        super().finish()
+
+# A localhost server for the tools that drive the terminal without the keyboard (stream decks, overlays)
+class ControlServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, state_manager: TerminalStateManager, logger: Logger, port: int, token: str = ""):
+        super().__init__((CONTROL_HOST, port), ControlHandler)
+        self.commands = ControlCommands(state_manager, logger)
+        self.logger = logger
+        self.token = token.encode() # Every command has to carry it, when set
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        '''The port it listens on, also when it was started on port 0'''
+        return self.server_address[1]
+
+    def authorized(self, request: Any) -> bool:
+        '''Does the request carry the token, always True without a token'''
+        if not self.token:
+            return True
+        token = request.get("token") if isinstance(request, dict) else None
+        return isinstance(token, str) and hmac.compare_digest(token.encode(), self.token)
+
+    def start(self) -> None:
+        self.thread.start()
+        self.logger.info("Control server listening on %s:%d", CONTROL_HOST, self.port)
+        if not self.token:
+            self.logger.warning("CONTROL_TOKEN is not set, any program on this machine can send commands")
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,81 @@
+from time import sleep
+from typing import Callable
+from .config import ConfigSingleton
+from .output_backend import OutputBackend
+
+# Typed to check if a delay is reliable
+PROBE_LINE = "abcdefghij0123456789"
+# Added on top of the fastest reliable delay found by the calibration
+CALIBRATION_MARGIN = 1.2
+
+# Keeps the writer pacing tuned to how fast keys are really typed, when ADAPTIVE_DELAY is on
+#
+# A key is held for the calibrated KEYBOARD_INPUT_DELAY, never shorter: only the calibration can show that a
+# shorter delay is still reliable. The writer waits for the delay plus the oversleep measured on this machine,
+# times the pacing factor, which grows when keys pile up in the emitter and shrinks back while the emitter keeps up
+class DelayController:
+    def __init__(self):
+        self.config = ConfigSingleton()
+
+        self.pacing = 1.3 # Processing speed estimate, the writer waits delay*pacing per key
+        self.timing_error = 0.0 # Smoothed oversleep of a key, in seconds
+
+    @property
+    def delay(self) -> float:
+        '''How long a key is held, the calibrated delay within MIN/MAX_KEYBOARD_INPUT_DELAY'''
+        config = self.config.snapshot
+        return min(config.MAX_KEYBOARD_INPUT_DELAY, max(config.MIN_KEYBOARD_INPUT_DELAY, config.KEYBOARD_INPUT_DELAY))
+
+    def record_key(self, target: float, actual: float, backlog: int) -> None:
+        '''A key was typed, target is the delay it should have taken and actual what it took'''
+        self.timing_error = 0.9*self.timing_error + 0.1*max(0.0, actual - target)
+
+        # Keys are piling up, the writer is faster than the emitter
+        if backlog > 1:
+            self.pacing = min(3.0, self.pacing + 0.05)
+        elif backlog == 0:
+            self.pacing = max(1.0, self.pacing - 0.01)
+
+    def wait_time(self) -> float:
+        '''How long the writer should wait per key'''
+        return (self.delay + self.timing_error)*self.pacing
+
+def type_probe(backend: OutputBackend, delay: float) -> None:
+    for key in [*PROBE_LINE, 'enter']:
+        backend.press(key)
+        sleep(delay)
+        backend.release(key)
+
+def simulated_terminal_check(min_key_interval: float) -> Callable[[float], bool]:
+    '''Accepts a delay when the probe lands correctly in a SimulatedGameTerminal'''
+    from .simulated_terminal import SimulatedGameTerminal
+
+    def check(delay: float) -> bool:
+        terminal = SimulatedGameTerminal(min_key_interval)
+        type_probe(terminal, delay)
+        lines = terminal.get_lines()
+        return len(lines) == 1 and lines[0][1] == PROBE_LINE and terminal.rejected_keys == 0
+    return check
+
+def user_confirmed_check(backend: OutputBackend) -> Callable[[float], bool]:
+    '''Types the probe into the focused window, the user confirms if it came out right'''
+    def check(delay: float) -> bool:
+        print(f"Focus the game terminal or a text editor, typing with a {delay*1000:.1f}ms delay in 3 seconds")
+        sleep(3)
+        type_probe(backend, delay)
+        answer = input(f"Was '{PROBE_LINE}' typed exactly? [y/n] ")
+        return answer.strip().lower().startswith('y')
+    return check
+
+def calibrate(check: Callable[[float], bool], repeats: int = 3, steps: int = 7) -> float:
+    '''Binary search the fastest delay that passes the check every time, plus a safety margin'''
+    config = ConfigSingleton()
+    low = config.get("MIN_KEYBOARD_INPUT_DELAY")
+    high = config.get("MAX_KEYBOARD_INPUT_DELAY")
+    for _ in range(steps):
+        middle = (low + high) / 2
+        if all(check(middle) for _ in range(repeats)):
+            high = middle
+        else:
+            low = middle
+    return min(config.get("MAX_KEYBOARD_INPUT_DELAY"), high*CALIBRATION_MARGIN)
@@ -0,0 +1,63 @@
+from typing import Optional, TextIO
+import sys
+import threading
+from .event import EventType
+
+# The UI of --headless: a plain text line whenever the state, the traps or the last event change, without rich.
+# Same render, rerender and stop as TerminalUI, the lines are written by a background thread
+class HeadlessStatus:
+    def __init__(self, state_manager, output: Optional[TextIO] = None):
+        self.state_manager = state_manager
+        self.output = output if output is not None else sys.stdout
+
+        self.condition = threading.Condition()
+        self.dirty = False # Did something change?
+        self.running = False
+        self.thread = None
+        self.last_line = ""
+
+    def render(self) -> None:
+        '''Write the first status line, starts the writer thread'''
+        self.running = True
+        self.write_status()
+        self.thread = threading.Thread(target=self.status_loop, daemon=True)
+        self.thread.start()
+
+    def status_loop(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and not self.dirty:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                self.dirty = False
+            self.write_status()
+
+    def rerender(self) -> None:
+        '''Request a new status line, never blocks the caller'''
+        with self.condition:
+            self.dirty = True
+            self.condition.notify()
+
+    def status_line(self) -> str:
+        state_manager = self.state_manager
+        traps = "ALL TRAPS" if state_manager.want_all_traps else ' '.join(state_manager.traps) or "none"
+        line = f"[{state_manager.state.name}] traps: {traps}"
+        if state_manager.event.type != EventType.NONE and state_manager.event.text:
+            mark = "!" if state_manager.event.type == EventType.FAIL else "-"
+            line += f" {mark} {state_manager.event.text}"
+        return line
+
+    def write_status(self) -> None:
+        line = self.status_line()
+        # Only the changes, the trap cycles refresh a lot
+        if line != self.last_line:
+            self.last_line = line
+            print(line, file=self.output, flush=True)
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
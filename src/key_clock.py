@@ -0,0 +1,39 @@
+from time import perf_counter_ns, sleep
+
+# The last part of a wait that is spun instead of slept, sleep can overshoot by about this much
+SPIN_THRESHOLD_NS = 1_000_000
+
+def sleep_until(deadline_ns: int) -> None:
+    '''Coarse sleep until close to the deadline, then spin for the rest'''
+    remaining = deadline_ns - perf_counter_ns()
+    if remaining > SPIN_THRESHOLD_NS:
+        sleep((remaining - SPIN_THRESHOLD_NS) / 1e9)
+    while perf_counter_ns() < deadline_ns:
+        pass
+
+# Paces a run of keys
+#
+# In precise mode every wait ends on an absolute deadline, one step after the previous deadline,
+# so the time spent pressing keys and the sleep overshoot do not add up over a long run.
+# When the clock fell behind by more than a step, it starts again from now instead of bursting to catch up
+class KeyClock:
+    def __init__(self, precise: bool):
+        self.precise = precise
+        self.deadline = perf_counter_ns()
+
+    def start(self) -> None:
+        '''The next wait is measured from now'''
+        self.deadline = perf_counter_ns()
+
+    def wait(self, seconds: float) -> None:
+        if not self.precise:
+            sleep(seconds)
+            return
+
+        step = int(seconds*1e9)
+        now = perf_counter_ns()
+        # Missed by more than a whole step, e.g. after being idle
+        if now - self.deadline > step:
+            self.deadline = now
+        self.deadline += step
+        sleep_until(self.deadline)
@@ -0,0 +1,18 @@
+from typing import Callable
+import keyboard
+from .output_backend import OutputBackend, KeyEvent
+
+# The real keyboard, through the OS hooks of the keyboard library
+class KeyboardBackend(OutputBackend):
+    def press(self, key: str) -> None:
+        keyboard.press(key)
+
+    def release(self, key: str) -> None:
+        keyboard.release(key)
+
+    def hook(self, callback: Callable[[KeyEvent], bool]) -> None:
+        keyboard.hook(callback, suppress=True)
+
+    def wait(self) -> None:
+        # Wait for a keyboard event
+        keyboard.wait()
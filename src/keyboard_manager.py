@@ -1,49 +1,188 @@
-from time import sleep
-from typing import Callable, List
-import keyboard
+from time import perf_counter, perf_counter_ns
+from typing import Any, Callable, List, Optional, Tuple
 import threading
 from collections import deque
 from logging import Logger
 from .config import ConfigSingleton
+from .output_backend import OutputBackend, KeyEvent, KEY_DOWN, create_backend
+from .session_recorder import SessionRecorder, HOOKED, EMITTED
+from .delay_controller import DelayController
+from .key_clock import KeyClock
+from .metrics import LatencyMetrics, QUEUE_WAIT, HOOK_TO_PRESS
 
 class KeyboardManager:
-    def __init__(self, logger: Logger):
-        self.queue = deque()
+    def __init__(self, logger: Logger, backend: Optional[OutputBackend] = None, recorder: Optional[SessionRecorder] = None):
+        self.queue = deque() # (keys, is batched, perf_counter_ns it was enqueued, perf_counter_ns of the hooked key that caused it, done event)
+        self.pending_keys = 0 # Amount of keys in the queue
         self.lock = threading.Lock()
+        self.key_available = threading.Condition(self.lock) # Signalled when a key is enqueued or on stop
         self.running = True  # keep running or end?
 
+        # Counters, to measure the emitter
+        self.keys_pressed = 0
+        self.units_pressed = 0 # A single key or a whole batch
+        self.total_latency = 0.0 # Sum of the enqueue to press latency, in seconds
+        self.max_latency = 0.0
+        self.max_queue_depth = 0
+
         self.logger = logger
+        self.config = ConfigSingleton()
+        self.backend = backend if backend is not None else create_backend() # Where the keys are typed
+        self.recorder = recorder # Logs the hooked and emitted keys, when recording a session
+        self.metrics = LatencyMetrics() # Latency of every stage of the key path
+        # Tunes the delay while typing, when ADAPTIVE_DELAY is on
+        self.delay_controller = DelayController() if self.config.get("ADAPTIVE_DELAY") else None
+        # Sleep then spin on absolute deadlines, when TIMING_MODE is precise
+        self.precise_timing = self.config.get("TIMING_MODE") == "precise"
+        self.clock = KeyClock(self.precise_timing)
+        self.core = None # The event loop that owns the state machine, in the asyncio core mode
+
+        self.start()
 
+    def start(self) -> None:
+        '''Start the emitter'''
         self.thread = threading.Thread(target=self.process_keys)
         self.thread.start()
-        self.config = ConfigSingleton()
+
+    def take_unit(self) -> Tuple[Tuple[str, ...], bool, Any]:
+        '''Take the next unit to type off the queue and count it, must be called while holding the lock'''
+        keys, batched, enqueued_at, hooked_at, done = self.queue.popleft()
+        self.pending_keys -= len(keys)
+        self.keys_pressed += len(keys)
+        now = perf_counter_ns()
+        self.record_latency((now - enqueued_at) / 1e9)
+        self.metrics.add(QUEUE_WAIT, now - enqueued_at)
+        if hooked_at is not None:
+            self.metrics.add(HOOK_TO_PRESS, now - hooked_at)
+        return keys, batched, done
+
     def process_keys(self):
-        while self.running:
-            key = None
-            with self.lock:
-                if len(self.queue) > 0:
-                    key = self.queue.popleft()
-                    self.logger.debug(f"Typing {key}")
-            if key is not None:
-                keyboard.press(key)
-                sleep(self.config.get("KEYBOARD_INPUT_DELAY"))
-                keyboard.release(key)
+        while True:
+            with self.key_available:
+                # Sleep until there is something to type, no polling
+                while self.running and len(self.queue) == 0:
+                    self.key_available.wait()
+                if not self.running:
+                    return
+                keys, batched, done = self.take_unit()
+
+            # Outside of the lock, the hook thread never waits for the log
+            self.logger.debug("Typing %s", keys)
+
+            self.clock.start()
+            if batched:
+                self.type_batch(keys)
             else:
-                sleep(0.01)
-                    
+                for key in keys:
+                    delay = self.key_delay()
+                    started = perf_counter()
+                    self.backend.press(key)
+                    self.clock.wait(delay)
+                    self.backend.release(key)
+                    if self.delay_controller:
+                        self.delay_controller.record_key(delay, perf_counter() - started, self.pending_keys)
+
+            done.set()
+
+    def key_delay(self) -> float:
+        '''How long a key is held down'''
+        if self.delay_controller:
+            return self.delay_controller.delay
+        return self.config.snapshot.KEYBOARD_INPUT_DELAY
+
+    def key_wait_time(self) -> float:
+        '''How long the caller should wait per key, so keys do not pile up in the queue'''
+        if self.delay_controller:
+            return self.delay_controller.wait_time()
+        return self.config.snapshot.KEYBOARD_INPUT_DELAY*1.3 # Added processing speed estimate
+
+    def type_batch(self, keys: Tuple[str, ...]) -> None:
+        '''Type a whole sequence with the batch timing profile'''
+        for key in keys:
+            # A reloaded config applies from the next key
+            config = self.config.snapshot
+            self.backend.press(key)
+            self.clock.wait(config.BATCH_KEY_DELAY)
+            self.backend.release(key)
+            # Give the game time to process a submitted line
+            self.clock.wait(config.BATCH_LINE_DELAY if key == 'enter' else config.BATCH_INTER_KEY_DELAY)
+
+    def record_latency(self, latency: float) -> None:
+        '''Update the counters, must be called while holding the lock'''
+        self.units_pressed += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def enqueue(self, keys: Tuple[str, ...], batched: bool) -> threading.Event:
+        if self.recorder:
+            for key in keys:
+                self.recorder.record(EMITTED, key)
+        done = threading.Event()
+        hooked_at = self.metrics.origin()
+        with self.key_available:
+            self.queue.append((keys, batched, perf_counter_ns(), hooked_at, done))
+            self.pending_keys += len(keys)
+            self.max_queue_depth = max(self.max_queue_depth, self.pending_keys)
+            self.key_available.notify()
+        return done
 
     def press_key(self, key: str):
+        self.enqueue((key,), False)
+
+    def press_sequence(self, keys: Tuple[str, ...]) -> threading.Event:
+        '''Type a key sequence as one unit, each key with the key mode timing'''
+        return self.enqueue(tuple(keys), False)
+
+    def press_keys(self, keys: List[str]) -> threading.Event:
+        '''Type a whole line or key sequence as one unit, using the batch timing profile.
+
+        Returns an event that is set once the last key has been released'''
+        return self.enqueue(tuple(keys), True)
+
+    @property
+    def queue_depth(self) -> int:
+        '''The amount of keys waiting to be typed'''
+        return self.pending_keys
+
+    def get_stats(self) -> dict:
+        '''Snapshot of the emitter counters'''
         with self.lock:
-            self.queue.append(key)
-    
+            average_latency = self.total_latency / self.units_pressed if self.units_pressed > 0 else 0.0
+            return {
+                "queue_depth": self.pending_keys,
+                "max_queue_depth": self.max_queue_depth,
+                "keys_pressed": self.keys_pressed,
+                "average_latency": average_latency,
+                "max_latency": self.max_latency,
+                "key_delay": self.key_delay(),
+                "key_wait_time": self.key_wait_time(),
+            }
+
     def stop(self):
-        self.running = False 
+        with self.key_available:
+            self.running = False
+            # Release anyone waiting on keys that will never be typed
+            for _, _, _, _, done in self.queue:
+                done.set()
+            self.queue.clear()
+            self.pending_keys = 0
+            self.key_available.notify_all()
         # Wait for the thread to finish
         self.thread.join()
 
+    def hook(self, callback: Callable[[KeyEvent], bool]) -> None:
+        '''Install the global keyboard hook, the key is blocked when the callback returns False'''
+        if self.recorder:
+            hook_callback = callback
+            def recording_callback(event: KeyEvent) -> bool:
+                if event.event_type == KEY_DOWN:
+                    self.recorder.record(HOOKED, event.name)
+                return hook_callback(event)
+            callback = recording_callback
+        self.backend.hook(callback)
+
     def wait(self):
-        # Wait for a keyboard event
-        keyboard.wait()
+        self.backend.wait()
 
     def keys_to_string(self, key_array: List[str]):
         output = ""
@@ -55,14 +194,27 @@ class KeyboardManager:
                     output += " "
         return output
 
+def create_keyboard_manager(logger: Logger, backend: Optional[OutputBackend] = None,
+                            recorder: Optional[SessionRecorder] = None) -> KeyboardManager:
+    '''The keyboard manager of the CORE_MODE and EMITTER_MODE in the config'''
+    config = ConfigSingleton()
+    if config.get("CORE_MODE", "threads") == "asyncio":
+        from .async_core import AsyncCore, AsyncKeyboardManager
+        return AsyncKeyboardManager(logger, AsyncCore(), backend, recorder)
+    if config.get("EMITTER_MODE", "thread") == "process":
+        from .process_emitter import ProcessKeyboardManager
+        return ProcessKeyboardManager(logger, backend, recorder)
+    return KeyboardManager(logger, backend, recorder)
+
 # Decorator for keyboard setup
 # Reduce repeated code for keyboard setup
 def keyboard_setup(suppress: bool = True) -> Callable:
     def decorator(func):
-        def wrapper(self):
+        def wrapper(self, *args):
             self.listen_to_keyboard(suppress)
             self.buffer.clear()
-            func(self)
+            func(self, *args)
+            self.select_keymap()
             if self.refresh_callback:
                 self.refresh_callback()
         return wrapper
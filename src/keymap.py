@@ -0,0 +1,100 @@
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+from logging import Logger
+from .config import ConfigSingleton
+
+# The key bindings of every state, "key key ..." -> action
+# "*" holds the bindings shared by every state except GAMEPLAY
+DEFAULT_KEY_BINDINGS = {
+    "*": {
+        "ctrl c": "cancel",
+    },
+    "GAMEPLAY": {
+        "t enter": "open_terminal",
+    },
+    "TERMINAL": {
+        "tab tab": "gameplay",
+        "a": "add_trap",
+        "x": "remove_trap",
+        "i": "insert_text",
+        "s": "switch_user",
+        "v": "view_monitor",
+        "t": "transmit_text",
+        "p": "ping_radar",
+        "f": "flash_radar",
+        "q q": "toggle_all_traps",
+        "d": "dump_metrics",
+    },
+    "SWITCH_USER": {
+        "s": "switch",
+    },
+}
+
+# Matches key sequences with an Aho-Corasick automaton, compiled once from the bindings.
+#
+# Every key is a single dictionary lookup, no matter how many bindings there are.
+# A binding fires as soon as its last key is typed, whatever was typed before it
+class KeyMap:
+    def __init__(self, bindings: Dict[Tuple[str, ...], str]):
+        # The trie of the bindings
+        goto = [{}] # node -> key -> node
+        outputs = [None] # node -> action of the binding ending there
+        for sequence, action in bindings.items():
+            node = 0
+            for key in sequence:
+                if key not in goto[node]:
+                    goto.append({})
+                    outputs.append(None)
+                    goto[node][key] = len(goto) - 1
+                node = goto[node][key]
+            outputs[node] = action
+
+        # Fold the failure links into a full transition table, breadth first
+        self.transitions = [dict(edges) for edges in goto]
+        fail = [0]*len(goto)
+        queue = deque(goto[0].values())
+        while len(queue) > 0:
+            node = queue.popleft()
+            if outputs[node] is None:
+                outputs[node] = outputs[fail[node]]
+            for key, fail_key_node in self.transitions[fail[node]].items():
+                if key not in goto[node]:
+                    self.transitions[node][key] = fail_key_node
+            for key, child in goto[node].items():
+                fail[child] = self.transitions[fail[node]].get(key, 0)
+                queue.append(child)
+        self.outputs = outputs
+        self.node = 0
+
+    def advance(self, key: str) -> Optional[str]:
+        '''Feed a typed key, returns the action of a binding that was completed'''
+        self.node = self.transitions[self.node].get(key.lower(), 0)
+        return self.outputs[self.node]
+
+    def reset(self) -> None:
+        self.node = 0
+
+def parse_sequence(sequence: str) -> Tuple[str, ...]:
+    return tuple(key.lower() for key in sequence.split())
+
+def load_key_bindings(states: List[str], actions: List[str], logger: Logger) -> Dict[str, KeyMap]:
+    '''Compile a KeyMap for every state, from DEFAULT_KEY_BINDINGS and the KEY_BINDINGS of the config'''
+    config = ConfigSingleton()
+    tables = {}
+    for table in [DEFAULT_KEY_BINDINGS, config.get("KEY_BINDINGS", {})]:
+        for state, bindings in table.items():
+            tables.setdefault(state, {}).update(bindings)
+
+    keymaps = {}
+    for state in states:
+        bindings = {}
+        shared = tables.get("*", {}) if state != "GAMEPLAY" else {}
+        for sequence, action in [*shared.items(), *tables.get(state, {}).items()]:
+            if action not in actions:
+                logger.warning("Unknown action '%s' bound to '%s' in %s", action, sequence, state)
+                continue
+            keys = parse_sequence(sequence)
+            if len(keys) > 0:
+                bindings[keys] = action
+        keymaps[state] = KeyMap(bindings)
+    return keymaps
@@ -0,0 +1,120 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from typing import Any, List, Tuple
+import logging
+import struct
+
+LOG_FILE = "lethal_terminal.log"
+
+# Binary trace: a header, then records. A message template is written once, events refer to it by id
+TRACE_MAGIC = b"LTTRACE1"
+TEMPLATE = 0 # kind, template id, length, template
+EVENT = 1 # kind, nanoseconds since the epoch, level, template id, amount of arguments, then the arguments
+TEMPLATE_HEADER = struct.Struct("<BHH")
+EVENT_HEADER = struct.Struct("<BqBHB")
+# Argument types
+INT = struct.Struct("<cq")
+FLOAT = struct.Struct("<cd")
+TEXT = struct.Struct("<cH")
+
+# Puts the records on a queue without formatting them, the listener thread formats and writes them
+#
+# The arguments are formatted later, so callers pass immutable values (e.g. a string, not the to_be_written deque)
+class LazyQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # The traceback does not outlive the caller's frame
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+# Writes log records as compact binary events, the message templates are stored once
+class BinaryTraceHandler(logging.Handler):
+    def __init__(self, path: str):
+        super().__init__()
+        self.file = open(path, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.templates = {} # Template -> id
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.write_event(record)
+        except Exception:
+            self.handleError(record)
+
+    def write_event(self, record: logging.LogRecord) -> None:
+        template = str(record.msg)
+        if template not in self.templates:
+            self.templates[template] = len(self.templates)
+            data = template.encode()
+            self.file.write(TEMPLATE_HEADER.pack(TEMPLATE, self.templates[template], len(data)) + data)
+
+        args = record.args if isinstance(record.args, tuple) else ()
+        parts = [EVENT_HEADER.pack(EVENT, int(record.created*1e9), record.levelno, self.templates[template], len(args))]
+        for arg in args:
+            if isinstance(arg, int):
+                parts.append(INT.pack(b"i", arg))
+            elif isinstance(arg, float):
+                parts.append(FLOAT.pack(b"f", arg))
+            else:
+                data = str(arg).encode()[:0xFFFF]
+                parts.append(TEXT.pack(b"s", len(data)) + data)
+        self.file.write(b"".join(parts))
+
+    def close(self) -> None:
+        self.file.close()
+        super().close()
+
+def setup_logging(level: int, max_bytes: int, backup_count: int, trace_file: str = "") -> QueueListener:
+    '''Send every log record through a queue to a background writer, returns the started listener.
+
+    The writer rotates lethal_terminal.log, or writes a binary trace when trace_file is set'''
+    if trace_file:
+        handler = BinaryTraceHandler(trace_file)
+    else:
+        handler = RotatingFileHandler(LOG_FILE, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+    log_queue = SimpleQueue()
+    logging.basicConfig(level=level, handlers=[LazyQueueHandler(log_queue)])
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+def load_trace(path: str) -> List[Tuple[int, int, str]]:
+    '''The (nanoseconds since the epoch, level, message) events of a binary trace'''
+    with open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"'{path}' is not a binary trace")
+        data = f.read()
+
+    templates = {}
+    events = []
+    offset = 0
+    while offset < len(data):
+        if data[offset] == TEMPLATE:
+            _, template_id, length = TEMPLATE_HEADER.unpack_from(data, offset)
+            offset += TEMPLATE_HEADER.size
+            templates[template_id] = data[offset:offset + length].decode()
+            offset += length
+            continue
+
+        _, timestamp, level, template_id, arg_count = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        args: List[Any] = []
+        for _ in range(arg_count):
+            arg_type = data[offset:offset + 1]
+            if arg_type == b"i":
+                args.append(INT.unpack_from(data, offset)[1])
+                offset += INT.size
+            elif arg_type == b"f":
+                args.append(FLOAT.unpack_from(data, offset)[1])
+                offset += FLOAT.size
+            else:
+                length = TEXT.unpack_from(data, offset)[1]
+                offset += TEXT.size
+                args.append(data[offset:offset + length].decode())
+                offset += length
+        template = templates[template_id]
+        events.append((timestamp, level, template % tuple(args) if args else template))
+    return events
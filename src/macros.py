@@ -0,0 +1,59 @@
+from logging import Logger
+from typing import Dict, List, Optional, Tuple
+from .config import ConfigSingleton
+
+# The terminal commands, a template per macro. {player} and {radar} become every name of PLAYERS or RADARS.
+# A line is submitted with enter, unless the template ends with a space: then the user finishes the line (e.g. transmit)
+DEFAULT_MACROS = {
+    "switch": "switch",
+    "switch_player": "switch {player}",
+    "ping_radar": "ping {radar}",
+    "flash_radar": "flash {radar}",
+    "view_monitor": "view monitor",
+    "transmit": "transmit ",
+}
+
+# Placeholder -> the config list it is filled from
+TARGETS = {"player": "PLAYERS", "radar": "RADARS"}
+
+# A command compiled once into the key sequences it types, one per player or radar when it has a placeholder
+class Macro():
+    def __init__(self, name: str, target: Optional[str], sequences: Tuple[Tuple[str, ...], ...]):
+        self.name = name
+        self.target = target # "player", "radar" or None
+        self.sequences = sequences
+
+    def sequence(self, index: int = 0) -> Optional[Tuple[str, ...]]:
+        '''The keys for the player or radar at index, None when there is no such player or radar'''
+        if 0 <= index < len(self.sequences):
+            return self.sequences[index]
+        return None
+
+def text_to_keys(text: str) -> Tuple[str, ...]:
+    return tuple('space' if character == ' ' else character for character in text)
+
+def compile_macro(name: str, template: str, targets: Dict[str, List[str]]) -> Macro:
+    '''The key sequences of a template: enter to start on an empty line, the text, then enter to submit it'''
+    submit = ('enter',) if not template.endswith(' ') else ()
+    for target, values in targets.items():
+        placeholder = "{" + target + "}"
+        if placeholder in template:
+            sequences = tuple(('enter', *text_to_keys(template.replace(placeholder, value)), *submit) for value in values)
+            return Macro(name, target, sequences)
+    return Macro(name, None, (('enter', *text_to_keys(template), *submit),))
+
+def load_macros(logger: Logger) -> Dict[str, Macro]:
+    '''Compile DEFAULT_MACROS and the MACROS of the config, for the PLAYERS and RADARS of the config'''
+    config = ConfigSingleton()
+    targets = {target: config.get(key, []) for target, key in TARGETS.items()}
+    macros = {}
+    for name, template in {**DEFAULT_MACROS, **config.get("MACROS", {})}.items():
+        if not isinstance(template, str) or template.strip() == "":
+            # The key bindings and the control server rely on the default macros
+            if name not in DEFAULT_MACROS:
+                logger.warning("Macro '%s' needs a non empty text template", name)
+                continue
+            logger.warning("Macro '%s' needs a non empty text template, kept '%s'", name, DEFAULT_MACROS[name])
+            template = DEFAULT_MACROS[name]
+        macros[name] = compile_macro(name, template, targets)
+    return macros
@@ -0,0 +1,80 @@
+from array import array
+from time import perf_counter_ns
+from typing import Dict, List, Optional
+import json
+import threading
+
+# Latencies kept per stage, older ones are overwritten
+RING_SIZE = 1024
+
+# The stages a key goes through, in nanoseconds
+HOOK_TO_HANDLED = "hook_to_handled" # The state handler processing a hooked key
+QUEUE_WAIT = "queue_wait" # Waiting in the emitter queue until it is pressed
+HOOK_TO_PRESS = "hook_to_press" # From the hook until the key it caused is pressed
+USER_LINE_WAIT = "user_line_wait" # A user line waiting for the trap writer
+TRAP_CYCLE = "trap_cycle" # How long a trap cycle took
+STAGES = [HOOK_TO_HANDLED, QUEUE_WAIT, HOOK_TO_PRESS, USER_LINE_WAIT, TRAP_CYCLE]
+
+# A preallocated ring buffer of integers
+class RingBuffer:
+    def __init__(self, size: int):
+        self.values = array('q', bytes(8*size))
+        self.size = size
+        self.count = 0 # Values ever added
+
+    def add(self, value: int) -> None:
+        self.values[self.count % self.size] = value
+        self.count += 1
+
+    def snapshot(self) -> List[int]:
+        return list(self.values[:min(self.count, self.size)])
+
+# Latency of every stage of the key path, cheap enough for the keyboard hook
+class LatencyMetrics:
+    def __init__(self):
+        self.rings = {stage: RingBuffer(RING_SIZE) for stage in STAGES}
+        # When the key being handled on this thread was hooked, so the keys it types can be traced back
+        self.local = threading.local()
+
+    def add(self, stage: str, nanoseconds: int) -> None:
+        self.rings[stage].add(nanoseconds)
+
+    def set_origin(self, hooked_at: Optional[int]) -> None:
+        self.local.origin = hooked_at
+
+    def origin(self) -> Optional[int]:
+        return getattr(self.local, "origin", None)
+
+    def version(self) -> int:
+        '''Changes whenever a latency is added'''
+        return sum(ring.count for ring in self.rings.values())
+
+    def summary(self, stage: str) -> Dict[str, float]:
+        '''Count, p50, p99 and max of a stage, in milliseconds'''
+        values = sorted(self.rings[stage].snapshot())
+        if len(values) == 0:
+            return {"count": 0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+        return {
+            "count": len(values),
+            "p50": values[len(values) // 2] / 1e6,
+            "p99": values[min(len(values) - 1, int(len(values)*0.99))] / 1e6,
+            "max": values[-1] / 1e6,
+        }
+
+    def histogram(self, stage: str) -> Dict[str, int]:
+        '''Power of two buckets, in microseconds, of the latencies in the ring'''
+        buckets = {}
+        for value in self.rings[stage].snapshot():
+            bucket = 1 << max(0, value // 1000).bit_length()
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        return {f"<{bucket}us": buckets[bucket] for bucket in sorted(buckets)}
+
+    def dump(self, path: str, gauges: Dict[str, float]) -> None:
+        '''Write the summaries, histograms and gauges to a JSON file'''
+        data = {
+            "time_ns": perf_counter_ns(),
+            "gauges": gauges,
+            "stages": {stage: {"summary": self.summary(stage), "histogram": self.histogram(stage)} for stage in STAGES},
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=4)
@@ -0,0 +1,105 @@
+from abc import ABC, abstractmethod
+from time import perf_counter_ns
+from typing import Callable, List, Optional, Tuple
+import threading
+from .config import ConfigSingleton
+
+# Same values as the keyboard library
+KEY_DOWN = 'down'
+KEY_UP = 'up'
+
+# A key event coming from a hook, mirrors keyboard.KeyboardEvent
+class KeyEvent():
+    def __init__(self, event_type: str, name: str):
+        self.event_type = event_type
+        self.name = name
+
+# Where the emitted keys are sent, and where the user keys come from. A backend missing a method cannot be created
+class OutputBackend(ABC):
+    @abstractmethod
+    def press(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def release(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def hook(self, callback: Callable[[KeyEvent], bool]) -> None:
+        '''Install the global keyboard hook, the key is blocked when the callback returns False'''
+
+    @abstractmethod
+    def wait(self) -> None:
+        '''Block until the program should end'''
+
+# An in-memory stand-in for the game terminal, rebuilds the lines it is typed
+class VirtualTerminalBackend(OutputBackend):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current_line = [] # What is typed on the line that was not submitted yet
+        self.lines: List[Tuple[int, str]] = [] # (perf_counter_ns when enter was pressed, line)
+        self.keys: List[Tuple[int, str]] = [] # (perf_counter_ns, key) of every pressed key
+        self.callbacks = [] # Installed hooks
+        self.stopped = threading.Event()
+
+    def press(self, key: str) -> None:
+        self.record_press(perf_counter_ns(), key)
+
+    def record_press(self, now: int, key: str) -> None:
+        '''A key that was pressed at perf_counter_ns now, e.g. by the emitter process'''
+        with self.lock:
+            self.keys.append((now, key))
+            self.type_key(now, key)
+
+    def type_key(self, now: int, key: str) -> None:
+        '''Apply a key to the line like the terminal would, called while holding the lock'''
+        if key == 'enter':
+            self.lines.append((now, ''.join(self.current_line)))
+            self.current_line.clear()
+        elif key == 'backspace':
+            if len(self.current_line) > 0:
+                self.current_line.pop()
+        elif key == 'space':
+            self.current_line.append(' ')
+        elif len(key) == 1:
+            self.current_line.append(key)
+
+    def release(self, key: str) -> None:
+        pass
+
+    def hook(self, callback: Callable[[KeyEvent], bool]) -> None:
+        self.callbacks.append(callback)
+
+    def send_user_key(self, name: str) -> bool:
+        '''Act as the user pressing a key, returns if the key reaches the terminal'''
+        passed = True
+        for callback in self.callbacks:
+            passed = callback(KeyEvent(KEY_DOWN, name)) and passed
+        for callback in self.callbacks:
+            callback(KeyEvent(KEY_UP, name))
+        if passed:
+            self.press(name)
+        return passed
+
+    def get_lines(self) -> List[Tuple[int, str]]:
+        with self.lock:
+            return list(self.lines)
+
+    def wait(self) -> None:
+        self.stopped.wait()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+def create_backend(name: Optional[str] = None) -> OutputBackend:
+    '''The backend named in OUTPUT_BACKEND of the config'''
+    if name is None:
+        name = ConfigSingleton().get("OUTPUT_BACKEND", "keyboard")
+    match name:
+        case "keyboard":
+            # Only needs the keyboard library, and its OS hooks, when it is used
+            from .keyboard_backend import KeyboardBackend
+            return KeyboardBackend()
+        case "virtual":
+            return VirtualTerminalBackend()
+    raise ValueError(f"Unknown OUTPUT_BACKEND '{name}'")
@@ -0,0 +1,237 @@
+from multiprocessing import shared_memory
+from time import perf_counter_ns
+from typing import Optional, Tuple
+import logging
+import multiprocessing
+import struct
+import threading
+from .config import ConfigSingleton, ConfigWatcher
+from .keyboard_manager import KeyboardManager
+from .output_backend import OutputBackend, VirtualTerminalBackend, create_backend
+from .session_recorder import EMITTED
+from .key_clock import KeyClock
+from .metrics import QUEUE_WAIT, HOOK_TO_PRESS
+
+# Shared memory layout: a ring of keys to type, a ring of acks for the typed keys, then a cancel byte
+KEY_SLOTS = 4096
+ACK_SLOTS = 4096
+KEY_SLOT = struct.Struct("<IB15s") # unit id, flags, key name
+ACK_SLOT = struct.Struct("<IBq") # unit id, flags, perf_counter_ns when the key was pressed
+ACK_OFFSET = KEY_SLOTS*KEY_SLOT.size
+CANCEL_OFFSET = ACK_OFFSET + ACK_SLOTS*ACK_SLOT.size # Set on shutdown, the keys left in the ring are skipped
+
+# Flags of a key slot or an ack
+FIRST = 1 # First key of a unit
+LAST = 2 # Last key of a unit
+BATCHED = 4 # Typed with the batch timing profile
+STOP = 8 # The emitter process ends
+
+# A unit of keys typed by the emitter process, waiting for its acks
+class PendingUnit():
+    def __init__(self, keys: Tuple[str, ...], enqueued_at: int, hooked_at: Optional[int], done: threading.Event):
+        self.keys = keys
+        self.enqueued_at = enqueued_at
+        self.hooked_at = hooked_at
+        self.done = done
+        self.acked = 0 # Keys typed so far
+
+# The KeyboardManager of EMITTER_MODE process, the keys are typed by a child process
+#
+# The keys go through a ring buffer in shared memory, the child acks every key it pressed, with the time it pressed it.
+# The child does not share the GIL with the UI and the hook, so their work does not delay a key.
+# When the output is a VirtualTerminalBackend, the child only keeps the time and the keys are replayed into it from the acks
+class ProcessKeyboardManager(KeyboardManager):
+    def start(self) -> None:
+        context = multiprocessing.get_context("spawn")
+        self.shared = shared_memory.SharedMemory(create=True, size=CANCEL_OFFSET + 1)
+        self.items = context.Semaphore(0) # Keys written, not read by the child yet
+        self.space = context.Semaphore(KEY_SLOTS) # Free key slots
+        self.acks = context.Semaphore(0) # Acks written, not read yet
+        self.ack_space = context.Semaphore(ACK_SLOTS) # Free ack slots
+
+        self.write_lock = threading.Lock() # Writing into the key ring, held apart from self.lock so acks never wait on a full ring
+        self.write_index = 0
+        self.ack_index = 0
+        self.next_unit = 0
+        self.units = {} # Unit id -> PendingUnit
+        self.acks_stopped = False
+        self.mirror = isinstance(self.backend, VirtualTerminalBackend)
+
+        output = "" if self.mirror else self.config.get("OUTPUT_BACKEND", "keyboard")
+        self.process = context.Process(
+            target=run_emitter,
+            args=(self.shared.name, self.items, self.space, self.acks, self.ack_space, output),
+            daemon=True,
+        )
+        self.process.start()
+        self.thread = threading.Thread(target=self.process_acks)
+        self.thread.start()
+
+    def enqueue(self, keys: Tuple[str, ...], batched: bool) -> threading.Event:
+        if self.recorder:
+            for key in keys:
+                self.recorder.record(EMITTED, key)
+        done = threading.Event()
+        if len(keys) == 0:
+            done.set()
+            return done
+
+        with self.lock:
+            if not self.running:
+                done.set()
+                return done
+            unit_id = self.next_unit
+            self.next_unit = (self.next_unit + 1) & 0xFFFFFFFF
+            self.units[unit_id] = PendingUnit(keys, perf_counter_ns(), self.metrics.origin(), done)
+            self.pending_keys += len(keys)
+            self.max_queue_depth = max(self.max_queue_depth, self.pending_keys)
+
+        with self.write_lock:
+            for i, key in enumerate(keys):
+                flags = BATCHED if batched else 0
+                if i == 0:
+                    flags |= FIRST
+                if i == len(keys) - 1:
+                    flags |= LAST
+                self.write_slot(unit_id, flags, key)
+        return done
+
+    def write_slot(self, unit_id: int, flags: int, key: str) -> None:
+        '''Put a key in the ring, must be called while holding the write lock'''
+        self.space.acquire()
+        KEY_SLOT.pack_into(self.shared.buf, (self.write_index % KEY_SLOTS)*KEY_SLOT.size, unit_id, flags, key.encode()[:15])
+        self.write_index += 1
+        self.items.release()
+
+    def process_acks(self) -> None:
+        '''Count the keys the child typed, and set the done event of a unit once its last key is typed'''
+        while True:
+            self.acks.acquire()
+            if self.acks_stopped:
+                return
+            unit_id, flags, pressed_at = ACK_SLOT.unpack_from(self.shared.buf, ACK_OFFSET + (self.ack_index % ACK_SLOTS)*ACK_SLOT.size)
+            self.ack_index += 1
+            self.ack_space.release()
+            if flags & STOP:
+                return
+
+            with self.lock:
+                unit = self.units.get(unit_id)
+                if unit is None:
+                    continue
+                key = unit.keys[unit.acked]
+                if unit.acked == 0:
+                    self.record_latency((pressed_at - unit.enqueued_at) / 1e9)
+                    self.metrics.add(QUEUE_WAIT, pressed_at - unit.enqueued_at)
+                    if unit.hooked_at is not None:
+                        self.metrics.add(HOOK_TO_PRESS, pressed_at - unit.hooked_at)
+                unit.acked += 1
+                self.keys_pressed += 1
+                self.pending_keys -= 1
+                if flags & LAST:
+                    del self.units[unit_id]
+
+            if self.mirror:
+                self.backend.record_press(pressed_at, key)
+            if flags & LAST:
+                unit.done.set()
+
+    def stop(self) -> None:
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+
+        # The child skips what is left in the ring, acks the stop and ends
+        self.shared.buf[CANCEL_OFFSET] = 1
+        with self.write_lock:
+            if self.space.acquire(timeout=1):
+                KEY_SLOT.pack_into(self.shared.buf, (self.write_index % KEY_SLOTS)*KEY_SLOT.size, 0, STOP, b"")
+                self.write_index += 1
+                self.items.release()
+        self.thread.join(timeout=5)
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        if self.thread.is_alive():
+            self.acks_stopped = True
+            self.acks.release()
+            self.thread.join()
+
+        with self.lock:
+            # Release anyone waiting on keys that will never be typed
+            for unit in self.units.values():
+                unit.done.set()
+            self.units.clear()
+            self.pending_keys = 0
+        self.shared.close()
+        self.shared.unlink()
+
+def run_emitter(shared_name: str, items, space, acks, ack_space, output: str) -> None:
+    '''The child process, types the keys of the ring until it reads a STOP'''
+    # Shares the resource tracker of the parent, which unlinks the shared memory
+    shared = shared_memory.SharedMemory(name=shared_name)
+    # The child has its own config, it follows the changes of the file like the parent
+    watcher = ConfigWatcher(logging.getLogger("Lethal Terminal Emitter"))
+    watcher.start()
+    try:
+        ChildEmitter(shared.buf, acks, ack_space, create_backend(output) if output else None).run(items, space)
+    finally:
+        watcher.stop()
+        shared.close()
+
+# Types the keys read from the ring, with the timing of KeyboardManager
+class ChildEmitter:
+    def __init__(self, buf: memoryview, acks, ack_space, backend: Optional[OutputBackend]):
+        self.buf = buf
+        self.acks = acks
+        self.ack_space = ack_space
+        self.backend = backend # None when only the press times are needed
+        self.config = ConfigSingleton()
+        self.clock = KeyClock(self.config.get("TIMING_MODE") == "precise")
+        self.ack_index = 0
+
+    def run(self, items, space) -> None:
+        read_index = 0
+        while True:
+            items.acquire()
+            unit_id, flags, key = KEY_SLOT.unpack_from(self.buf, (read_index % KEY_SLOTS)*KEY_SLOT.size)
+            read_index += 1
+            space.release()
+            if flags & STOP:
+                self.ack(0, STOP, perf_counter_ns())
+                return
+
+            if self.buf[CANCEL_OFFSET]:
+                continue
+            if flags & FIRST:
+                self.clock.start()
+            self.type_key(unit_id, flags, key.rstrip(b"\0").decode())
+
+    def type_key(self, unit_id: int, flags: int, key: str) -> None:
+        config = self.config.snapshot
+        if flags & BATCHED:
+            hold = config.BATCH_KEY_DELAY
+            # Give the game time to process a submitted line
+            pause = config.BATCH_LINE_DELAY if key == 'enter' else config.BATCH_INTER_KEY_DELAY
+        else:
+            hold = config.KEYBOARD_INPUT_DELAY
+            pause = 0
+
+        pressed_at = perf_counter_ns()
+        if self.backend:
+            self.backend.press(key)
+        self.clock.wait(hold)
+        if self.backend:
+            self.backend.release(key)
+        if pause > 0:
+            self.clock.wait(pause)
+        # Acked once it is done, like the emitter thread sets the done event after the release
+        self.ack(unit_id, flags, pressed_at)
+
+    def ack(self, unit_id: int, flags: int, pressed_at: int) -> None:
+        self.ack_space.acquire()
+        ACK_SLOT.pack_into(self.buf, ACK_OFFSET + (self.ack_index % ACK_SLOTS)*ACK_SLOT.size, unit_id, flags, pressed_at)
+        self.ack_index += 1
+        self.acks.release()
@@ -0,0 +1,68 @@
+from time import perf_counter_ns
+from typing import List, Optional, Tuple
+import struct
+import threading
+from .key_clock import sleep_until
+from .output_backend import KeyEvent, KEY_DOWN
+
+# Kinds of recorded keys
+HOOKED = 0 # The user pressed it, seen by the keyboard hook
+EMITTED = 1 # Lethal Terminal typed it
+
+# File header, then one fixed width record per key: nanoseconds since the start, kind, key name
+MAGIC = b"LTREC001"
+RECORD = struct.Struct("<qB15s")
+
+# Writes every hooked and emitted key to a compact binary log
+class SessionRecorder:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.start = perf_counter_ns()
+
+    def record(self, kind: int, key: str) -> None:
+        data = RECORD.pack(perf_counter_ns() - self.start, kind, key.encode()[:15])
+        with self.lock:
+            if self.file:
+                self.file.write(data)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+def load_session(path: str) -> List[Tuple[int, int, str]]:
+    '''The (nanoseconds since the start, kind, key) records of a recorded session'''
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{path}' is not a recorded session")
+        data = f.read()
+    records = []
+    for timestamp, kind, key in RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size]):
+        records.append((timestamp, kind, key.rstrip(b"\0").decode()))
+    return records
+
+def keys_of_kind(records: List[Tuple[int, int, str]], kind: int) -> List[str]:
+    return [key for _, record_kind, key in records if record_kind == kind]
+
+# Feeds the hooked keys of a recorded session back into a TerminalStateManager
+class SessionReplayer:
+    def __init__(self, records: List[Tuple[int, int, str]]):
+        self.records = records
+
+    def replay(self, state_manager, original_speed: bool = True, stop: Optional[threading.Event] = None) -> int:
+        '''Replay at the recorded timing, or as fast as possible. Returns the amount of keys replayed'''
+        start = perf_counter_ns()
+        replayed = 0
+        for timestamp, kind, key in self.records:
+            if kind != HOOKED:
+                continue
+            if stop is not None and stop.is_set():
+                break
+            if original_speed:
+                sleep_until(start + timestamp)
+            state_manager.handle_hook_event(KeyEvent(KEY_DOWN, key))
+            replayed += 1
+        return replayed
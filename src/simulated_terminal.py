@@ -0,0 +1,85 @@
+from typing import Dict, List, Tuple
+from .output_backend import VirtualTerminalBackend
+from .traps import is_valid_trap
+
+# The first word of the terminal commands that are logged
+COMMANDS = ["switch", "ping", "flash", "transmit", "view"]
+
+# A stand-in for the in-game terminal, which loses keys that come in too fast
+#
+# A key pressed less than min_key_interval after the previous accepted key is dropped, garbling its line.
+# Every submitted line is classified as a trap code, a command or an error
+class SimulatedGameTerminal(VirtualTerminalBackend):
+    def __init__(self, min_key_interval: float = 0.015):
+        super().__init__()
+        self.min_key_interval_ns = int(min_key_interval*1e9)
+        self.last_accepted = None # perf_counter_ns of the last accepted key
+
+        self.accepted_keys = 0
+        self.rejected_keys = 0
+        self.line_garbled = False # Did the current line lose a key?
+
+        self.landed: List[Tuple[int, str, str]] = [] # (perf_counter_ns, "trap" or "command", line)
+        self.errors: List[Tuple[int, str]] = [] # (perf_counter_ns, line) of garbled or unknown lines
+
+    def type_key(self, now: int, key: str) -> None:
+        if self.last_accepted is not None and now - self.last_accepted < self.min_key_interval_ns:
+            self.rejected_keys += 1
+            self.line_garbled = True
+            return
+        self.last_accepted = now
+        self.accepted_keys += 1
+
+        if key == 'enter':
+            line = ''.join(self.current_line)
+            self.classify_line(now, line)
+            self.line_garbled = False
+        super().type_key(now, key)
+
+    def classify_line(self, now: int, line: str) -> None:
+        '''Log the line that was submitted, called while holding the lock'''
+        line = line.strip()
+        if line == "":
+            # A lost key could have been the whole line
+            if self.line_garbled:
+                self.errors.append((now, line))
+            return
+
+        if self.line_garbled:
+            self.errors.append((now, line))
+        elif is_valid_trap(line):
+            self.landed.append((now, "trap", line))
+        elif line.split()[0] in COMMANDS:
+            self.landed.append((now, "command", line))
+        else:
+            self.errors.append((now, line))
+
+    def reset(self) -> None:
+        '''Forget what landed so far, e.g. the keys typed to open the terminal'''
+        with self.lock:
+            self.accepted_keys = 0
+            self.rejected_keys = 0
+            self.landed.clear()
+            self.errors.clear()
+
+    def get_landed(self) -> List[Tuple[int, str, str]]:
+        with self.lock:
+            return list(self.landed)
+
+    def trap_refresh_periods(self) -> Dict[str, List[float]]:
+        '''Trap -> seconds between its landings'''
+        last_landed = {}
+        periods = {}
+        for landed_at, kind, line in self.get_landed():
+            if kind != "trap":
+                continue
+            if line in last_landed:
+                periods.setdefault(line, []).append((landed_at - last_landed[line]) / 1e9)
+            last_landed[line] = landed_at
+        return periods
+
+    def error_rate(self) -> float:
+        '''The share of submitted lines that were garbled or not understood'''
+        with self.lock:
+            total = len(self.landed) + len(self.errors)
+            return len(self.errors) / total if total > 0 else 0.0
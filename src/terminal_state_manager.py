@@ -1,15 +1,24 @@
 from enum import Enum
-from typing import Callable, List, Optional
+from functools import partial
+from typing import Any, Callable, Iterator, List, Optional, Sequence
 from collections import deque
-from time import sleep, time
-import keyboard
+from time import time, perf_counter_ns
+from logging import Logger, DEBUG
 import threading
-from logging import Logger
 
-from .traps import is_valid_trap
+from .traps import TrapRegistry, ALL_TRAPS, parse_trap_ranges, load_trap_settings, default_trap_settings, TrapSettings
+from .trap_planner import TrapPlanner
+from .trap_saver import TrapSaver
+from .trap_writer import TrapWriter
+from .keymap import load_key_bindings
+from .macros import load_macros
 from .keyboard_manager import keyboard_setup, KeyboardManager
-from .config import ConfigSingleton
+from .config import ConfigSingleton, ConfigSnapshot
 from .event import Event, EventType
+from .output_backend import KeyEvent, KEY_DOWN
+from .key_clock import KeyClock
+from .command_queue import Command, CommandQueue, PendingLine, SYSTEM, USER_LINE, TRAP_REFRESH
+from .metrics import HOOK_TO_HANDLED, USER_LINE_WAIT, TRAP_CYCLE, STAGES
 
 # Representing the states which the vim motions is in
 class State(Enum):
@@ -22,27 +31,31 @@ class State(Enum):
     SWITCH_USER = 6
     FLASH_RADAR = 7
     PING_RADAR = 8
+    MACRO_TARGET = 9
 
 # The brain behind the whole operation
 class TerminalStateManager:
-    def __init__(self, keyboard_manager: KeyboardManager, logger: Logger):
+    def __init__(self, keyboard_manager: KeyboardManager, logger: Logger, traps_file: Optional[str] = None):
         # Keyboard buffers
         self.buffer = deque([]) # What the keyboard has typed
-        self.to_be_written = deque([]) # What the user is about to write before the interuption by the automated trap system
-        self.writing_queue = deque([]) # The things that are to be typed
+        self.to_be_written = PendingLine() # What the user is about to write before the interuption by the automated trap system
+        self.commands = CommandQueue() # What the trap writer types: system commands, user lines and trap refreshes
 
         # The traps (e.g. mines, turrets)
-        self.traps = [] # List of traps
+        self.traps = TrapRegistry() # The traps that are set, loaded from TRAPS_FILE below
+        self.traps_version = 0 # Changes whenever the traps, their settings or want_all_traps change
         # All the traps in the game
-        self.all_traps = [f"{chr(i)}{j}" for i in range(ord('a'), ord('z')+1) for j in range(10)]
+        self.all_traps = ALL_TRAPS
         self.current_trap = [] # What the user is typing
+        self.trap_planner = TrapPlanner() # Picks the traps that fit in each cycle
+        self.trap_priorities = {} # Trap -> settings of the priority set from Add Trap or the control server
+        self.trap_settings = load_trap_settings() # Trap -> priority and refresh interval, TRAP_SETTINGS then trap_priorities
 
         # Flags
         self.first_terminal_enter = True # Makes you type view monitor on the first go
-        self.run_auto_trap_thread = True
+        self.suppress = False # Block the user keys from reaching the game?
         self.want_all_traps = False # Will type all combinations
         self.is_auto_typing_traps = False # Is the computer typing the traps right now?
-        self.is_running_manager = False
 
         # UI
         self.event = Event("", EventType.NONE)
@@ -53,15 +66,90 @@ class TerminalStateManager:
 
         # Dependencies
         self.keyboard_manager = keyboard_manager
+        self.metrics = keyboard_manager.metrics
         self.logger = logger
         self.config = ConfigSingleton() # Config
+        # Where the traps are kept between runs, empty to not keep them
+        self.traps_file = self.config.get("TRAPS_FILE", "") if traps_file is None else traps_file
+        self.load_traps()
+        # Writes the traps off the hook thread
+        self.trap_saver = TrapSaver(self.traps_file, logger) if self.traps_file else None
+        # The asyncio core, when the state machine runs on its event loop instead of the hook thread
+        self.core = keyboard_manager.core
+        # Without the asyncio core, keeps the hook thread and the control server from changing the state at once
+        self.key_lock = threading.Lock()
+        # The only worker typing traps
+        if self.core:
+            # Only imports asyncio when the asyncio core is used
+            from .async_core import AsyncTrapWriter
+            self.trap_writer = AsyncTrapWriter(self.automatic_trap_writing_cycle_async, logger, self.core)
+        else:
+            self.trap_writer = TrapWriter(self.automatic_trap_writing_cycle, logger)
 
         # The Current State
         self.state = State.GAMEPLAY
 
+        # Key bindings, action name -> what it does
+        self.actions = {
+            "open_terminal": self.open_terminal,
+            "terminal": self.terminal_state,
+            "gameplay": self.gameplay_state,
+            "add_trap": self.add_trap_state,
+            "remove_trap": self.remove_trap_state,
+            "insert_text": self.insert_text_state,
+            "switch_user": self.switch_user_state,
+            "switch": self.insert_switch_text,
+            "view_monitor": self.insert_view_monitor_text,
+            "transmit_text": self.transmit_text_state,
+            "ping_radar": self.switch_ping_state,
+            "flash_radar": self.switch_flash_state,
+            "toggle_all_traps": self.toggling_all_traps,
+            "cancel": self.cancel_commands,
+            "dump_metrics": self.dump_metrics,
+        }
+        self.pending_macro = None # The macro waiting for a player or radar number
+        self.compile_bindings()
+        # Macros, bindings and trap settings follow the changes of the config file
+        self.config.subscribe(self.reload_config)
+
         self.logger.debug("TerminalStateManager initialized.")
         self.gameplay_state()
+        self.keyboard_manager.hook(self.handle_hook_event)
     
+    def compile_bindings(self) -> None:
+        '''Compile the terminal commands, each can be bound as macro:<name>, then the key bindings'''
+        macros = load_macros(self.logger)
+        actions = {name: action for name, action in self.actions.items() if not name.startswith("macro:")}
+        for name in macros:
+            actions[f"macro:{name}"] = partial(self.start_macro, name)
+        keymaps = load_key_bindings([state.name for state in State], list(actions), self.logger)
+
+        self.macros, self.actions, self.keymaps = macros, actions, keymaps
+        self.keymap = self.keymaps[self.state.name]
+        # The macro waiting for a number was removed, or no longer takes one
+        if self.pending_macro not in self.macros or self.macros[self.pending_macro].target is None:
+            self.pending_macro = None
+
+    def reload_config(self, snapshot: ConfigSnapshot) -> None:
+        '''Called from the config watcher with the new config'''
+        if self.core:
+            self.core.call(self.apply_config)
+        else:
+            # Like a control command, never while a key is being handled
+            with self.key_lock:
+                self.apply_config()
+
+    def apply_config(self) -> None:
+        self.compile_bindings()
+        if self.state == State.MACRO_TARGET and self.pending_macro is None:
+            self.terminal_state()
+        # Rebuilt from the new TRAP_SETTINGS, a removed entry goes back to the default
+        self.trap_settings = {**load_trap_settings(), **self.trap_priorities}
+        self.traps_version += 1
+        self.set_event("Reloaded the config")
+        if self.refresh_callback:
+            self.refresh_callback()
+
     # Set the function for refreshing the UI
     def set_refresh_callback(self, callback: Callable) -> None:
         self.refresh_callback = callback
@@ -71,30 +159,39 @@ class TerminalStateManager:
         self.event.text = text
         self.event.type = type
 
+    def load_traps(self) -> None:
+        '''Set the traps saved in TRAPS_FILE by the last run'''
+        if not self.traps_file:
+            return
+        try:
+            self.traps = TrapRegistry.load(self.traps_file)
+            self.traps_version += 1
+        except (OSError, ValueError) as e:
+            self.logger.warning("Failed to load the traps: %s", e)
+
+    def save_traps(self) -> None:
+        if self.trap_saver:
+            self.trap_saver.save(self.traps)
+
+    # The priority and refresh interval of a trap
+    def get_trap_settings(self, trap: str) -> TrapSettings:
+        if trap in self.trap_settings:
+            return self.trap_settings[trap]
+        return default_trap_settings()
+
     # Clear all the things that was about to be written
     def clear_to_be_written_buffer(self) -> None:
         self.to_be_written.clear()
 
-    # Check if the last few characters in the buffer have been typed to the array
-    def is_typed(self, array: List[str]) -> bool:
-        '''Check if the array of keys has been typed in the user keyboard'''
-        if len(self.buffer) < len(array): 
-            return False
-        
-        # Check last n elements directly from deque
-        for i in range(len(array)):
-            if self.buffer[-(i + 1)].lower() != array[-(i + 1)].lower():
-                return False
-        
-        return True
-
     def handle_keyboard_logic(self) -> None:
         '''Keyboard logic for all states'''
+        # Key bindings come first, e.g. control + c leaves any state
+        action = self.keymap.advance(self.buffer[-1])
+        if action is not None:
+            self.actions[action]()
+            return
+
         match self.state: 
-            case State.GAMEPLAY:
-                self.handle_gameplay_keyboard()
-            case State.TERMINAL:
-                self.handle_terminal_keyboard()
             case State.ADD_TRAP:
                 self.handle_adding_trap_keyboard()
             case State.DELETE_TRAP:
@@ -103,14 +200,12 @@ class TerminalStateManager:
                 self.handle_insert_text_keyboard()
             case State.TRANSMIT_TEXT:
                 self.handle_suffix_text_enter_keyboard()
-            case State.PING_RADAR:
-                self.handle_radar_command("ping")
-            case State.FLASH_RADAR:
-                self.handle_radar_command("flash")
+            case State.PING_RADAR | State.FLASH_RADAR | State.MACRO_TARGET:
+                self.handle_macro_target_keyboard()
             case State.SWITCH_USER:
                 self.handle_switch_user_keyboard()
-            
-    def handle_key_buffer(self, key: str) -> None:
+
+    def handle_key_buffer(self, key: KeyEvent) -> None:
         '''Handling the addition of a new keyboard input'''
 
         # Add the key to the buffer
@@ -120,129 +215,225 @@ class TerminalStateManager:
         # Flush on enter
         if key.name == 'enter':
             self.buffer.clear()
+            self.keymap.reset()
 
         # No need for more than 50 characters in reality
         if len(self.buffer) > 50:
             self.buffer.popleft()
     
+    def handle_hook_event(self, event: KeyEvent) -> bool:
+        '''The single keyboard hook, returns if the key should reach the game'''
+        if event.event_type != KEY_DOWN:
+            return True
+
+        hooked_at = perf_counter_ns()
+        if self.core:
+            # Waits for the loop, so the keys hooked before this one have set the state it is decided by
+            return not self.core.run(self.handle_hooked_key, event, hooked_at)
+        with self.key_lock:
+            return not self.handle_hooked_key(event, hooked_at)
+
+    def handle_hooked_key(self, event: KeyEvent, hooked_at: int) -> bool:
+        '''Handle a hooked key, returns if it is suppressed'''
+        # Decided by the state the key was pressed in, before it changes the state
+        suppress = self.suppress
+        # The keys typed because of this key are traced back to when it was hooked
+        self.metrics.set_origin(hooked_at)
+        self.handle_key_buffer(event)
+        self.metrics.set_origin(None)
+        self.metrics.add(HOOK_TO_HANDLED, perf_counter_ns() - hooked_at)
+        return suppress
+
+    def run_control(self, func: Callable, *args) -> Any:
+        '''Run a command of the control server where the keys are handled, returns its result'''
+        if self.core:
+            return self.core.run(func, *args)
+        with self.key_lock:
+            return func(*args)
+
+    def status(self) -> dict:
+        '''The state, the traps, the trap cycle and the metrics, as streamed by the control server'''
+        return {
+            "state": self.state.name,
+            "traps": list(self.traps),
+            "all_traps": self.want_all_traps,
+            "typing_traps": self.is_auto_typing_traps,
+            "trap_cycles": self.trap_planner.cycle,
+            "event": self.event.text,
+            **self.metrics_gauges(),
+            "latency": {stage: self.metrics.summary(stage) for stage in STAGES},
+        }
+
     def listen_to_keyboard(self, suppress: bool) -> None:
         # If is auto typing, suppress the user input
-        keyboard.unhook_all()
-        keyboard.on_press(self.handle_key_buffer, suppress=suppress)
+        # The hook stays installed, only its policy changes
+        self.suppress = suppress
 
-    def handle_control_c(self) -> None:
-        '''Logic for pressing control+c'''
-        if self.is_typed(['ctrl', 'c']):
-            self.terminal_state()
+    def select_keymap(self) -> None:
+        '''Start matching the key bindings of the current state'''
+        self.keymap = self.keymaps[self.state.name]
+        self.keymap.reset()
 
     @keyboard_setup(False)
     def gameplay_state(self) -> None:
         self.state = State.GAMEPLAY
         self.clear_all_buffers() # Stop writing
-        self.run_auto_trap_thread = False
+        self.trap_writer.pause()
 
-    def handle_gameplay_keyboard(self) -> None:
+    def open_terminal(self) -> None:
         # Enter Terminal State
-        if self.is_typed(['t', 'enter']):
-            self.terminal_state()
-            self.insert_event_to_be_written('enter')
+        self.terminal_state()
+        self.insert_event_to_be_written('enter')
 
     @keyboard_setup()
     def terminal_state(self) -> None:
         self.state = State.TERMINAL
         self.clear_to_be_written_buffer() # Clear buffer
-        self.run_auto_trap_thread = True
-        if not self.is_running_manager:
-            threading.Thread(target=self.automatic_trap_writing_manager).start()
+        # Need to wait at the first for the user to type 'view monitor'
+        self.trap_writer.resume(delay=1)
 
         if self.first_terminal_enter:
             self.first_terminal_enter = False
             self.insert_view_monitor_text()
-    def handle_terminal_keyboard(self) -> None:
-        # Enter Gameplay State
-        if self.is_typed(['tab', 'tab']):
-            self.gameplay_state()
-        # Enter Adding Trap State
-        elif self.is_typed(['a']):
-            self.add_trap_state()
-        # Enter Removing Trap State
-        elif self.is_typed(['x']):
-            self.remove_trap_state()
-        # Enter Text Insertion state
-        elif self.is_typed(['i']):
-            self.insert_text_state()
-        # Enter switch player
-        elif self.is_typed(['s']):
-            self.switch_user_state()
-        # Enter view monitor text
-        elif self.is_typed(['v']):
-            self.insert_view_monitor_text()
-        # Transmit message state
-        elif self.is_typed(['t']):
-            self.transmit_text_state()
-        # Ping
-        elif self.is_typed(['p']):
-            self.switch_ping_state()
-        # Flash a Radar
-        elif self.is_typed(['f']):
-            self.switch_flash_state()
-        # Set all the traps
-        elif self.is_typed(['q', 'q']):
-           self.toggling_all_traps()
-       
-        # Control + C wipes buffer
-        self.handle_control_c()
 
     def toggling_all_traps(self):
-        if self.want_all_traps: 
-            self.writing_queue.clear() # Don't write if we disabled all traps
-            self.want_all_traps = False
-            self.set_event("Disabled typing all traps")
-        elif not self.want_all_traps:
-            self.want_all_traps = True
-            self.set_event("Enabled typing all traps")
+        self.set_all_traps(not self.want_all_traps)
+        self.terminal_state()
+
+    def set_all_traps(self, enabled: bool) -> None:
+        '''Turn typing all traps on or off, without leaving the current state'''
+        if enabled == self.want_all_traps:
+            return
+        if not enabled:
+            self.commands.cancel([TRAP_REFRESH]) # Don't write if we disabled all traps
+        self.want_all_traps = enabled
+        self.traps_version += 1
+        self.set_event("Enabled typing all traps" if enabled else "Disabled typing all traps")
 
         if self.refresh_callback:
             self.refresh_callback()
-        self.terminal_state()
+
+    def metrics_gauges(self) -> dict:
+        '''The current backlog of every stage and the refresh period of every trap, next to the latency metrics'''
+        refresh_periods = self.trap_planner.refresh_periods()
+        return {
+            "emitter_backlog": self.keyboard_manager.queue_depth,
+            "trap_cycle_duration": self.trap_planner.cycle_duration,
+            "trap_timer_duration": self.config.get("TRAP_TIMER_DURATION"),
+            "slowest_refresh_period": max(refresh_periods.values(), default=0.0),
+            # Trap -> seconds between two of its refreshes
+            "refresh_periods": {trap: round(period, 3) for trap, period in refresh_periods.items()},
+            "user_lines_waiting": self.commands.count(USER_LINE),
+            "command_queue": self.commands.get_stats(),
+        }
+
+    def dump_metrics(self) -> None:
+        path = self.config.get("METRICS_FILE")
+        try:
+            self.metrics.dump(path, self.metrics_gauges())
+            self.set_event(f"Dumped metrics to {path}")
+        except OSError as e:
+            self.logger.error("Failed to dump metrics: %s", e)
+            self.set_event(f"Failed to dump metrics to {path}", EventType.FAIL)
+        if self.refresh_callback:
+            self.refresh_callback()
 
     @keyboard_setup()
     def add_trap_state(self) -> None:
         self.state = State.ADD_TRAP
         self.current_trap.clear()
 
-    def handle_adding_trap_keyboard(self) -> None:
-        '''Logic for adding a trap (a1, b2) to the trap list'''
-        if len(self.buffer) >= 1 and len(self.buffer[-1]) == 1:
-            self.current_trap.append(self.buffer[-1])
+    def read_trap_entry(self, with_priority: bool) -> Optional[str]:
+        '''Collect the keys of a trap entry, returns the entry once it is complete.
 
-            # Handle delete
-            if self.buffer[-1] == 'backspace':
+        An entry is a trap (a1) or a letter (c*), with a leading priority digit when with_priority (2a1).
+        Starting with / reads a bulk line until enter (/a0-a9 c* d3)'''
+        if len(self.buffer) == 0:
+            return None
+        key = self.buffer[-1]
+        bulk = len(self.current_trap) > 0 and self.current_trap[0] == '/'
+
+        if key == 'backspace':
+            if len(self.current_trap) > 0:
                 self.current_trap.pop()
-                if len(self.current_trap) > 0:
-                    self.current_trap.pop()
+            return None
+        if bulk and key == 'enter':
+            entry = ''.join(self.current_trap)
+            self.current_trap.clear()
+            return entry
+        if bulk and key == 'space':
+            key = ' '
+        if len(key) != 1:
+            return None
+        self.current_trap.append(key)
+        if bulk or self.current_trap == ['/']:
+            return None
+
+        trap_keys = self.current_trap
+        if with_priority and trap_keys[0].isdigit():
+            trap_keys = trap_keys[1:]
+        if len(trap_keys) == 2:
+            entry = ''.join(self.current_trap)
+            self.current_trap.clear()
+            return entry
+        return None
 
+    def handle_adding_trap_keyboard(self) -> None:
+        '''Logic for adding traps (a1, 2b2, c*, /a0-a9 d3) to the trap list'''
+        entry = self.read_trap_entry(with_priority=True)
+        if entry is None:
+            return
 
-        if (len(self.current_trap) == 2):
-            trap = (self.current_trap[0] + self.current_trap[1])
-            if is_valid_trap(trap) and trap not in self.traps:
-                self.traps.append(trap)
-                self.set_event(f"Added trap: {trap}")
+        # An optional leading digit is the priority of the traps (e.g. 2a1)
+        spec = entry.lstrip('/')
+        priority = None
+        if not entry.startswith('/') and entry[0].isdigit():
+            priority = int(entry[0])
+            spec = entry[1:]
 
-                # Type the trap inputted
-                self.insert_event_to_be_written('enter')
-                for k in trap:
-                    self.insert_event_to_be_written(k) 
-                self.insert_event_to_be_written('enter')
+        traps = parse_trap_ranges(spec)
+        if priority == 0 or not traps:
+            self.set_event(f"Cannot add trap{' with priority 0' if priority == 0 else ''}: {spec}", EventType.FAIL)
+            self.terminal_state()
+            return
 
-            else:
-                self.set_event(f"Cannot add trap: {trap}", EventType.FAIL)
+        added = self.add_traps(traps, priority)
+        if len(traps) == 1 and len(added) == 1:
+            self.set_event(f"Added trap: {spec}")
+            # Type the trap inputted
+            self.insert_keys_to_be_written(['enter', *added[0], 'enter'])
+        elif len(added) == 0 and priority is not None:
+            # Already added, only change how often they are typed
+            self.set_event(f"Changed priority of {'trap' if len(traps) == 1 else 'traps'} {spec} to {priority}")
+        elif len(added) > 0:
+            # The next cycle types them
+            self.set_event(f"Added {len(added)} traps: {spec}")
+        else:
+            self.set_event(f"Cannot add trap: {spec}", EventType.FAIL)
 
-            # Return to Terminal State
-            self.terminal_state()
+        # Return to Terminal State
+        self.terminal_state()
 
-        self.handle_control_c()
 
+    def add_traps(self, traps: List[str], priority: Optional[int] = None) -> List[str]:
+        '''Add traps and set their priority when given, returns the traps that were not there yet'''
+        added = [trap for trap in traps if self.traps.add(trap)]
+        if priority is not None:
+            for trap in traps:
+                self.trap_priorities[trap] = default_trap_settings(priority)
+            self.trap_settings = {**self.trap_settings, **self.trap_priorities}
+        if len(added) > 0 or priority is not None:
+            self.traps_version += 1
+            self.save_traps()
+        return added
+
+    def remove_traps(self, traps: List[str]) -> List[str]:
+        '''Returns the traps that were removed'''
+        removed = [trap for trap in traps if self.traps.remove(trap)]
+        if len(removed) > 0:
+            self.traps_version += 1
+            self.save_traps()
+        return removed
 
     @keyboard_setup()
     def remove_trap_state(self) -> None:
@@ -250,37 +441,98 @@ class TerminalStateManager:
         self.current_trap.clear()
 
     def handle_delete_trap_keyboard(self) -> None:
-        '''Logic for removing a trap (a1, b2) from the trap list'''
-        if len(self.buffer) >= 1 and len(self.buffer[-1]) == 1:
-            self.current_trap.append(self.buffer[-1])
+        '''Logic for removing traps (a1, c*, /a0-a9 d3) from the trap list'''
+        entry = self.read_trap_entry(with_priority=False)
+        if entry is None:
+            return
 
-            # Handle delete
-            if self.buffer[-1] == 'backspace':
-                self.current_trap.pop()
-                if len(self.current_trap) > 0:
-                    self.current_trap.pop()
-
-            if (len(self.current_trap) == 2):
-                trap = (self.current_trap[0] + self.current_trap[1])
-                if is_valid_trap(trap) and trap in self.traps:
-                    self.traps.remove(trap)
-                    self.set_event(f"Removed trap: {trap}")
-                else:
-                    self.set_event(f"Cannot remove trap: {trap}", EventType.FAIL)
-                # Return to Terminal State
-                self.terminal_state()
+        spec = entry.lstrip('/')
+        traps = parse_trap_ranges(spec) or []
+        removed = self.remove_traps(traps)
+        if len(removed) > 0:
+            self.set_event(f"Removed trap: {spec}" if len(traps) == 1 else f"Removed {len(removed)} traps: {spec}")
+        else:
+            self.set_event(f"Cannot remove trap: {spec}", EventType.FAIL)
+        # Return to Terminal State
+        self.terminal_state()
 
-        self.handle_control_c()
+    def is_batch_emission(self) -> bool:
+        return self.config.snapshot.EMISSION_MODE == "batch"
 
-    def press_key_and_wait(self, key_event: str) -> None:
-        '''A function to pause the caller by the estimated amount of time the keypress would take.
-        
-        Timing is important overwise the writing_queue buffer would be overloaded with keys from start_automatic_trap_writing thread
-        Since we timed the key presses, we can update the writing_queue buffer and get live changes while the traps are being written
-        '''
-        self.keyboard_manager.press_key(key_event)
-        keyboard_delay = self.config.get("KEYBOARD_INPUT_DELAY")*1.3 # Added processing speed estimate
-        sleep(keyboard_delay)
+    def type_keys_and_wait(self, keys: List[str]) -> None:
+        '''Type a group of keys (e.g. a trap and enter), pausing the caller until it is typed.
+
+        In batch mode the group is sent to the emitter as one unit, otherwise key by key'''
+        if self.is_batch_emission():
+            self.keyboard_manager.press_keys(keys).wait()
+        else:
+            # Keys of a group are paced on one clock, so the waits do not drift
+            clock = KeyClock(self.keyboard_manager.precise_timing)
+            for key in keys:
+                self.keyboard_manager.press_key(key)
+                clock.wait(self.keyboard_manager.key_wait_time())
+
+    async def type_keys_async(self, keys: List[str]) -> None:
+        '''type_keys_and_wait on the loop of the asyncio core, other keys are handled while it waits'''
+        if self.is_batch_emission():
+            await self.keyboard_manager.press_keys(keys)
+        else:
+            clock = self.core.clock(self.keyboard_manager.precise_timing)
+            for key in keys:
+                self.keyboard_manager.press_key(key)
+                await clock.wait(self.keyboard_manager.key_wait_time())
+
+    def insert_keys_to_be_written(self, keys: Sequence[str]) -> None:
+        '''Handling typing a whole key sequence, like a macro.
+
+        When the system is not typing traps, the sequence is sent to the emitter as one unit,
+        in batch mode with the batch timing profile'''
+        if self.is_auto_typing_traps:
+            self.queue_system_command(keys)
+            return
+
+        if self.is_batch_emission():
+            self.keyboard_manager.press_keys(keys)
+        else:
+            self.keyboard_manager.press_sequence(keys)
+        # Keep what is left on the current line, like insert_event_to_be_written would
+        for k in keys:
+            if k == 'enter':
+                self.clear_to_be_written_buffer()
+            elif k == 'backspace':
+                self.to_be_written.pop()
+            elif len(k) == 1 or k == 'space':
+                self.to_be_written.append(k)
+
+    def queue_system_command(self, keys: Sequence[str]) -> None:
+        '''While traps are typed, the whole lines of a macro are queued as one system command.
+
+        What comes after its last enter (e.g. 'transmit ') continues the line the user is typing'''
+        if 'enter' not in keys:
+            for k in keys:
+                self.insert_event_to_be_written(k)
+            return
+
+        end = len(keys) - keys[::-1].index('enter')
+        command = keys[:end]
+        if command[0] == 'enter':
+            # The enter sends what the user was typing, the line is empty after it
+            if len(self.to_be_written) > 0:
+                self.commands.push(USER_LINE, (*self.to_be_written.take(), 'enter'))
+            command = command[1:]
+        # Only the enter, e.g. 'transmit ': nothing to type before the line the user finishes
+        if len(command) > 0 and self.commands.push(SYSTEM, command, dedupe_key=tuple(command)):
+            self.set_event(f"Will type: {self.keyboard_manager.keys_to_string(command)}")
+        for k in keys[end:]:
+            self.insert_event_to_be_written(k)
+
+    def cancel_commands(self) -> None:
+        '''Ctrl+C, back to the Terminal. Already in the Terminal, drops the system commands and user lines that were not typed yet'''
+        if self.state == State.TERMINAL:
+            cancelled = self.commands.cancel([SYSTEM, USER_LINE])
+            if cancelled > 0:
+                self.set_event(f"Cancelled {cancelled} waiting lines")
+        self.terminal_state()
 
     def insert_event_to_be_written(self, key_event: str) -> None:
         '''Handling typing a key.
@@ -290,7 +542,8 @@ class TerminalStateManager:
         # Add the latest event to the to_be_written list
         if len(key_event) == 1 or key_event in ['space', 'backspace']:
             self.to_be_written.append(key_event)
-            self.logger.debug(f"to_be_written buffer is {self.to_be_written}")
+            if self.logger.isEnabledFor(DEBUG):
+                self.logger.debug("to_be_written buffer is %s", ''.join(self.to_be_written))
         # If the system is not typing traps, handle user input directly
         if not self.is_auto_typing_traps:
             # handle the inputs given
@@ -305,29 +558,21 @@ class TerminalStateManager:
             if key_event == 'enter':
                 # Update UI Event
                 self.set_event(f"Will type: {self.keyboard_manager.keys_to_string(self.to_be_written)}")
-                if self.refresh_callback():
+                if self.refresh_callback:
                     self.refresh_callback()
 
-                # Send the line that was desired to be typed to the writing queue
-                self.to_be_written.append('enter')
-                self.writing_queue.appendleft(deque(self.to_be_written))
-
-                self.clear_to_be_written_buffer()
+                # Send the line that was desired to be typed to the command queue
+                self.commands.push(USER_LINE, (*self.to_be_written.take(), 'enter'))
         
         # Clean the to_be_written buffer, we don't want to save deletes, since it is just removing elements from the buffer
         if key_event == 'backspace':
             self.to_be_written.pop()
-            if len(self.to_be_written) > 0:
-                self.to_be_written.pop()
+            self.to_be_written.pop()
         
     @keyboard_setup()
     def insert_text_state(self) -> None:
         self.state = State.INSERT_TEXT
     def handle_insert_text_keyboard(self):
-        if self.is_typed(['ctrl', 'c']):
-            self.terminal_state()
-            return
-        
         if len(self.buffer) >= 1:
             event = self.buffer[-1]
             self.insert_event_to_be_written(event)
@@ -335,89 +580,71 @@ class TerminalStateManager:
     @keyboard_setup()
     def switch_user_state(self) -> None:        
         self.state = State.SWITCH_USER
-    def handle_switch_user_keyboard(self) -> None:
+    def insert_switch_text(self) -> None:
         # Switch
-        if self.is_typed(['s']):
-            for k in ['enter', 's','w','i','t','c','h','enter']:
-                self.insert_event_to_be_written(k)
-            self.terminal_state()
-
-        if len(self.buffer) >= 1:
-            number = self.buffer[-1]
-            # Get the number chosen
-            if number.isdigit():
-                value = int(number)-1
-                players = self.config.get("PLAYERS")
-                player = None
-                
-                if 0 <= value < len(players):
-                    player = players[value]
-
-                if player:
-                    self.to_be_written.clear()
-
-                    to_type = ['enter', 's','w','i','t','c','h','space']
-                    to_type.extend(list(player))
-                    to_type.append('enter')
-                    for k in to_type:
-                        self.insert_event_to_be_written(k)
-                else:
-                    self.set_event(f"No player number: {value}", EventType.FAIL)
-                self.terminal_state()
+        self.run_macro("switch")
+        self.terminal_state()
 
-        self.handle_control_c()
+    def handle_switch_user_keyboard(self) -> None:
+        self.pending_macro = "switch_player"
+        self.handle_macro_target_keyboard()
 
     @keyboard_setup()
     def switch_flash_state(self) -> None:        
         self.state = State.FLASH_RADAR
+        self.pending_macro = "flash_radar"
     @keyboard_setup()
     def switch_ping_state(self) -> None:        
         self.state = State.PING_RADAR
-    def handle_radar_command(self, command: str) -> None:
+        self.pending_macro = "ping_radar"
+
+    def run_macro(self, name: str, index: int = 0, suffix: Sequence[str] = ()) -> bool:
+        '''Type the precompiled keys of a macro, for the player or radar at index, then the suffix keys.
+        Returns False when there is no such player or radar'''
+        keys = self.macros[name].sequence(index)
+        if keys is None:
+            return False
+        keys = (*keys, *suffix)
+        if keys[0] == 'enter':
+            # The macro starts on a new line
+            self.to_be_written.clear()
+        self.insert_keys_to_be_written(keys)
+        return True
+
+    def start_macro(self, name: str) -> None:
+        '''The action of a macro from the config, one with a player or radar waits for its number'''
+        if self.macros[name].target is None:
+            self.run_macro(name)
+            self.terminal_state()
+        else:
+            self.macro_target_state(name)
+
+    @keyboard_setup()
+    def macro_target_state(self, name: str) -> None:
+        self.state = State.MACRO_TARGET
+        self.pending_macro = name
+
+    def handle_macro_target_keyboard(self) -> None:
+        '''A player or radar number was typed for the pending macro'''
         if len(self.buffer) >= 1:
             number = self.buffer[-1]
             if number.isdigit():
                 value = int(number)-1
-                radars = self.config.get("RADARS")
-                radar = None
-                
-                if 0 <= value < len(radars):
-                    radar = radars[value]
-
-                if radar:
-                    self.to_be_written.clear()
-
-                    to_type = ['enter']
-                    to_type.extend(list(command))
-                    to_type.append('space')
-                    to_type.extend(list(radar))
-                    to_type.append('enter')
-                    for k in to_type:
-                        self.insert_event_to_be_written(k)
-                else:
-                    self.set_event(f"No radar number: {value}", EventType.FAIL)
+                macro = self.macros[self.pending_macro]
+                if not self.run_macro(macro.name, value):
+                    self.set_event(f"No {macro.target} number: {value}", EventType.FAIL)
                 self.terminal_state()
-
-        self.handle_control_c()
     
     def insert_view_monitor_text(self) -> None:
-        self.to_be_written.clear()
-        for k in ['enter','v','i','e','w','space','m','o','n','i','t','o','r','enter']:
-            self.insert_event_to_be_written(k)
+        self.run_macro("view_monitor")
 
     @keyboard_setup()
     def transmit_text_state(self) -> None:
-        self.to_be_written.clear()
-        for k in ['enter','t','r','a','n','s','m','i','t','space']:
-            self.insert_event_to_be_written(k)
-        
+        self.run_macro("transmit")
+
         self.state = State.TRANSMIT_TEXT
 
     def handle_suffix_text_enter_keyboard(self) -> None:
-        if self.is_typed(['ctrl', 'c']):
-            self.terminal_state()
-            return
-
         if len(self.buffer) >= 1:
             event = self.buffer[-1]
             self.insert_event_to_be_written(event)
@@ -428,82 +655,113 @@ class TerminalStateManager:
 
     # Thread to handle writing the trap
     def start_automatic_trap_writing(self) -> None:
-        '''Writes the traps automatically from the writing_queue'''
+        '''Writes the traps automatically from the command queue'''
+        for keys in self.trap_writing_steps():
+            self.type_keys_and_wait(keys)
+
+    async def start_automatic_trap_writing_async(self) -> None:
+        '''start_automatic_trap_writing on the loop of the asyncio core'''
+        for keys in self.trap_writing_steps():
+            await self.type_keys_async(keys)
+
+    def trap_writing_steps(self) -> Iterator[List[str]]:
+        '''The keys of one trap writing cycle, the caller types each group and waits for it before taking the next'''
         self.is_auto_typing_traps = True
         self.logger.debug("Started automatic trap writing")
 
-        trap_list = self.traps
+        trap_list = list(self.traps)
         if self.want_all_traps:
             trap_list = self.all_traps
 
-        for trap in trap_list:
-            self.writing_queue.append(deque([trap[0], trap[1]]))
+        # Only type the traps that are due and fit in this cycle
+        settings = {trap: self.get_trap_settings(trap) for trap in trap_list}
+        for trap in self.trap_planner.plan(trap_list, settings):
+            self.commands.push(TRAP_REFRESH, (trap[0], trap[1], 'enter'), dedupe_key=trap)
 
         # Get rid of what the user was typing
-        self.press_key_and_wait('enter')
-        while len(self.writing_queue) > 0:
-            # Write is a list of keys to write
-            write = self.writing_queue.popleft()
-
-            for key in write:
-                self.press_key_and_wait(key)
+        if len(self.to_be_written) > 0:
+            yield ['enter']
+        keys_typed = 0
+        writing_start = time()
+        while len(self.commands) > 0:
+            # System commands and user lines go first, they only wait for the group that is being typed
+            command = self.next_command()
+            if command is not None:
+                yield command
+                keys_typed += len(command)
+                continue
 
-            self.press_key_and_wait('enter')
+            # Write is a list of keys to write
+            refreshes = self.next_trap_group()
+            group = [key for command in refreshes for key in command.keys]
+            yield group
+            keys_typed += len(group)
+            self.trap_planner.record_typed([command.dedupe_key for command in refreshes])
+        self.trap_planner.record_cycle(keys_typed, time() - writing_start)
+        self.metrics.add(TRAP_CYCLE, int(self.trap_planner.cycle_duration*1e9))
+        if self.logger.isEnabledFor(DEBUG):
+            self.logger.debug("Typed %d keys, traps are refreshed every %.2fs", keys_typed, self.trap_planner.refresh_period())
         time_since_start_of_trap_thread = time() - self.start_time
-        time_left = self.config.get("TRAP_TIMER_DURATION") - time_since_start_of_trap_thread
+        time_left = self.config.snapshot.TRAP_TIMER_DURATION - time_since_start_of_trap_thread
         # If there is time to return the terminal back to normal
         if time_left > 0:
-            # Try catch since the user could clear the self.to_be_written buffer at any time
-            try:
-                # Finish off user typed buffer that is not done from the terminal
-                for i in range(len(self.to_be_written)):
-                    self.press_key_and_wait(self.to_be_written[i])
-            except:
-                sleep(0.01)
+            # Finish off user typed buffer that is not done from the terminal
+            yield list(self.to_be_written.snapshot())
 
         self.logger.debug("Ended automatic trap writing")
         self.is_auto_typing_traps = False
-    
+
+        # A line could have been sent right before the flag was cleared
+        while True:
+            command = self.next_command()
+            if command is None:
+                break
+            yield command
+
+    def next_trap_group(self) -> List[Command]:
+        '''Take as many trap refreshes from the command queue as can be typed within MAX_USER_LINE_WAIT.
+
+        A user line sent while the group is typed waits at most that long'''
+        max_keys = int(self.config.snapshot.MAX_USER_LINE_WAIT / self.trap_planner.key_cost)
+        return self.commands.pop_group(TRAP_REFRESH, max_keys)
+
+    def next_command(self) -> Optional[List[str]]:
+        '''The keys of the oldest system command or user line sent while traps were typed, None when there is none'''
+        command = self.commands.pop([SYSTEM, USER_LINE])
+        if command is None:
+            return None
+        if command.kind == USER_LINE:
+            wait = perf_counter_ns() - command.enqueued_at
+            self.metrics.add(USER_LINE_WAIT, wait)
+            self.logger.debug("User line waited %.3fs", wait / 1e9)
+        return list(command.keys)
+
 
     def clear_all_buffers(self) -> None:
         self.clear_to_be_written_buffer()
         self.buffer.clear()
-        self.writing_queue.clear()
+        self.commands.cancel()
 
-    def automatic_trap_writing_manager(self) -> None:
-        '''The thread that manages the automatic trap writer
-        
-        Will call the trap writer every TRAP_TIMER_DURATION.
-        If automatic trap writing takes a long time, it is compensated in the timer'''
-
-        self.is_running_manager = True
-        ideal_timer = self.config.get("TRAP_TIMER_DURATION")
-
-        initial_call = True
-        while self.run_auto_trap_thread:
-            if self.state is not State.GAMEPLAY:
-                self.start_time = time()
-
-                # Need to wait at the first for the user to type 'view monitor'
-                if initial_call:
-                    sleep(1)
-                    initial_call = False
-
-                if (len(self.traps) > 0 or self.want_all_traps):
-                    thread = threading.Thread(target=self.start_automatic_trap_writing)
-                    thread.start()
-                    # wait for the thread to finish
-                    thread.join()
-
-                elapsed_time = time() - self.start_time
-                remaining_time = max(0, ideal_timer - elapsed_time)
-
-                # If there is still time left, wait
-                while remaining_time > 0 and self.state is not State.GAMEPLAY:
-                    sleep_time = min(0.1, remaining_time)
-                    sleep(sleep_time)
-                    remaining_time -= sleep_time
-
-            else:
-                sleep(0.1)
-        self.is_running_manager = False
\ No newline at end of file
+    def automatic_trap_writing_cycle(self) -> None:
+        '''One cycle of the trap writer worker, called every TRAP_TIMER_DURATION outside of gameplay'''
+        self.start_time = time()
+        if (len(self.traps) > 0 or self.want_all_traps):
+            self.start_automatic_trap_writing()
+            # Show the new refresh periods
+            if self.refresh_callback:
+                self.refresh_callback()
+
+    async def automatic_trap_writing_cycle_async(self) -> None:
+        '''automatic_trap_writing_cycle on the loop of the asyncio core'''
+        self.start_time = time()
+        if (len(self.traps) > 0 or self.want_all_traps):
+            await self.start_automatic_trap_writing_async()
+            if self.refresh_callback:
+                self.refresh_callback()
+
+    def stop(self) -> None:
+        self.config.unsubscribe(self.reload_config)
+        # Stop the trap writer worker
+        self.trap_writer.stop()
+        if self.trap_saver:
+            self.trap_saver.stop()
@@ -1,10 +1,30 @@
-from rich.console import Console
+import threading
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, List, Tuple
+from rich.console import Console, ConsoleOptions, Group, RenderableType, RenderResult
+from rich.segment import Segment
+from rich.live import Live
 from rich.panel import Panel
 from rich.text import Text
 from rich.table import Table
 from rich.columns import Columns
-from .config import ConfigSingleton
+from .config import ConfigSingleton, ConfigSnapshot
 from .event import EventType
+from .metrics import STAGES
+
+# How often (in seconds) the metrics panel is redrawn while nothing else happens
+METRICS_INTERVAL = 1.0
+
+class PrerenderedLines:
+    """Lines rendered once, so rich does not lay them out again on every frame."""
+    def __init__(self, lines: List[List[Segment]]):
+        self.lines = lines
+
+    def __rich_console__(self, console: Console, options: ConsoleOptions) -> RenderResult:
+        new_line = Segment.line()
+        for line in self.lines:
+            yield from line
+            yield new_line
 
 class TerminalUI:
     def __init__(self, state_manager):
@@ -12,50 +32,170 @@ class TerminalUI:
         self.state_manager = state_manager
         self.config = ConfigSingleton()
 
-        # Mock data for players and radars
-        self.players = self.config.get("PLAYERS")
-        self.radars = self.config.get("RADARS")
+        self.players = self.config.snapshot.PLAYERS
+        self.radars = self.config.snapshot.RADARS
+        self.config.subscribe(self.reload_config)
+        self.show_metrics = self.config.get("SHOW_METRICS", False)
+
+        # Region name -> (what it was built from, renderable)
+        self.regions: Dict[str, Tuple[Any, RenderableType]] = {}
+        self.title = Panel("[bold red]LETHAL[/bold red] [green]TERMINAL[/green]", border_style="red")
+        # (players, radars, width) -> player and radar tables, already laid out
+        self.tables_cache: Dict[Tuple[Tuple[str, ...], Tuple[str, ...], int], PrerenderedLines] = {}
+        self.live = None
+
+        # Render thread
+        self.condition = threading.Condition()
+        self.dirty = False # Was a new frame requested?
+        self.running = False
+        self.thread = None
 
     def render(self) -> None:
-        """Initial render of the terminal UI."""
+        """Initial render of the terminal UI, starts the render thread."""
         self.console.clear()
-        title = Panel("[bold red]LETHAL[/bold red] [green]TERMINAL[/green]", border_style="red")
-        self.console.print(title)
-        self.display_content()
+        self.update_regions()
+        self.live = Live(self.build_frame(), console=self.console, auto_refresh=False)
+        self.live.start()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.render_loop, daemon=True)
+        self.thread.start()
 
     def rerender(self) -> None:
-        """Update the terminal UI without clearing everything."""
-        self.console.clear()
-        self.display_content()
+        """Request a new frame, never blocks the caller. Bursts of requests are merged into one frame."""
+        with self.condition:
+            self.dirty = True
+            self.condition.notify()
+
+    def reload_config(self, snapshot: ConfigSnapshot) -> None:
+        """Show the players and radars of a reloaded config."""
+        self.players = snapshot.PLAYERS
+        self.radars = snapshot.RADARS
+        self.rerender()
+
+    def stop(self) -> None:
+        """Stop the render thread and the live display."""
+        self.config.unsubscribe(self.reload_config)
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+        if self.live:
+            self.live.stop()
+
+    def render_loop(self) -> None:
+        """Draw the requested frames, at most UI_MAX_FPS per second."""
+        # The metrics keep changing without a request, redraw them every so often
+        timeout = METRICS_INTERVAL if self.show_metrics else None
+        last_frame = 0.0
+        while True:
+            with self.condition:
+                while self.running and not self.dirty:
+                    if not self.condition.wait(timeout):
+                        break
+                if not self.running:
+                    return
+
+            # Requests coming in until the next frame is due are drawn together
+            remaining = last_frame + 1 / self.config.snapshot.UI_MAX_FPS - monotonic()
+            if remaining > 0:
+                sleep(remaining)
+            with self.condition:
+                self.dirty = False
 
-    def display_content(self) -> None:
-        """Display all content including tables and state."""
-        # State display
-        state_text = Text(f"\nState: {self.state_manager.state.name}", style="bold yellow")
-        self.console.print(state_text)
+            if self.update_regions():
+                self.live.update(self.build_frame(), refresh=True)
+            last_frame = monotonic()
 
-        # Traps box display logic
-        traps_display = "ALL TRAPS" if self.state_manager.want_all_traps else ' '.join(self.state_manager.traps)
-        traps_panel = Panel(traps_display, title="Traps", border_style="red")
-        self.console.print(traps_panel)
+    def update_regions(self) -> bool:
+        """Rebuild the regions whose data changed, returns if any did."""
+        state_manager = self.state_manager
+        regions: Tuple[Tuple[str, Any, Callable[[], RenderableType]], ...] = (
+            ("state", state_manager.state, self.create_state_text),
+            ("traps", (state_manager.traps_version, round(state_manager.trap_planner.refresh_period(), 1)),
+             self.create_traps_panel),
+            ("tables", self.tables_key(), self.get_tables),
+            ("event", (state_manager.event.text, state_manager.event.type), self.create_event_text),
+        )
+        if self.show_metrics:
+            regions += (("metrics", (state_manager.metrics.version(), state_manager.keyboard_manager.queue_depth),
+                         self.create_metrics_panel),)
 
-        # Create tables for players and radars
-        player_table = self.create_player_table()
-        radar_table = self.create_radar_table()
+        changed = False
+        for name, data, create in regions:
+            if name in self.regions and self.regions[name][0] == data:
+                continue
+            self.regions[name] = (data, create())
+            changed = True
+        return changed
 
-        # Use Columns to display tables side by side
-        columns = Columns([player_table, radar_table], equal=True)
-        self.console.print(columns)
+    def build_frame(self) -> Group:
+        """Put the regions together into one frame."""
+        names = ("state", "traps", "tables", "metrics", "event") if self.show_metrics else ("state", "traps", "tables", "event")
+        return Group(self.title, *(self.regions[name][1] for name in names))
 
-        # Print the event
-        event_text = ""
+    def create_state_text(self) -> Text:
+        """State display."""
+        return Text(f"\nState: {self.state_manager.state.name}", style="bold yellow")
+
+    def create_traps_panel(self) -> Panel:
+        """Traps box display logic."""
+        traps_display = "ALL TRAPS" if self.state_manager.want_all_traps else ' '.join(
+            self.format_trap(trap) for trap in self.state_manager.traps
+        )
+        refresh_period = self.state_manager.trap_planner.refresh_period()
+        return Panel(traps_display, title="Traps", subtitle=f"Slowest refresh every {refresh_period:.1f}s", border_style="red")
+
+    def tables_key(self) -> Tuple[Tuple[str, ...], Tuple[str, ...], int]:
+        """The tables only change with the config contents and the console width."""
+        return (tuple(self.players), tuple(self.radars), self.console.width)
+
+    def get_tables(self) -> PrerenderedLines:
+        """The player and radar tables, built and laid out once per config."""
+        key = self.tables_key()
+        if key not in self.tables_cache:
+            self.tables_cache[key] = PrerenderedLines(
+                self.console.render_lines(self.create_tables(), self.console.options, pad=False)
+            )
+        return self.tables_cache[key]
+
+    def create_tables(self) -> Columns:
+        """Use Columns to display the player and radar tables side by side."""
+        return Columns([self.create_player_table(), self.create_radar_table()], equal=True)
+
+    def create_event_text(self) -> Text:
+        """The last event."""
         if self.state_manager.event.type == EventType.SUCCESS:
-            event_text = Text(self.state_manager.event.text, style="bold bright_green")
+            return Text(self.state_manager.event.text, style="bold bright_green")
         elif self.state_manager.event.type == EventType.FAIL:
-            event_text = Text(self.state_manager.event.text, style="bold red1")
-        self.console.print(event_text)
+            return Text(self.state_manager.event.text, style="bold red1")
+        return Text("")
+
+    def create_metrics_panel(self) -> Panel:
+        """Latency of every stage of the key path, and how far behind the writers are."""
+        metrics_table = Table(expand=True, box=None)
+        metrics_table.add_column("Stage", justify="left")
+        for column in ("Count", "p50 (ms)", "p99 (ms)", "Max (ms)"):
+            metrics_table.add_column(column, justify="right")
 
-    def create_player_table(self) -> None:
+        for stage in STAGES:
+            summary = self.state_manager.metrics.summary(stage)
+            metrics_table.add_row(stage, str(summary["count"]), f"{summary['p50']:.2f}", f"{summary['p99']:.2f}", f"{summary['max']:.2f}")
+
+        gauges = self.state_manager.metrics_gauges()
+        subtitle = (f"Backlog {gauges['emitter_backlog']} keys, "
+                    f"trap cycle {gauges['trap_cycle_duration']:.2f}s of {gauges['trap_timer_duration']}s")
+        return Panel(metrics_table, title="Metrics", subtitle=subtitle, border_style="blue")
+
+    def format_trap(self, trap: str) -> str:
+        """A trap with its priority, when it is not the default one."""
+        priority = self.state_manager.get_trap_settings(trap).priority
+        if priority == self.config.snapshot.DEFAULT_TRAP_PRIORITY:
+            return trap
+        return f"{trap}:{priority}"
+
+    def create_player_table(self) -> Table:
         """Create a table for players."""
         player_table = Table(title="Players")
         player_table.add_column("No.", justify="center")
@@ -63,10 +203,10 @@ class TerminalUI:
 
         for idx, player in enumerate(self.players):
             player_table.add_row(str(idx + 1), player)
-        
+
         return player_table
 
-    def create_radar_table(self) -> None:
+    def create_radar_table(self) -> Table:
         """Create a table for radars."""
         radar_table = Table(title="Radars")
         radar_table.add_column("No.", justify="center")
@@ -74,5 +214,5 @@ class TerminalUI:
 
         for idx, radar in enumerate(self.radars):
             radar_table.add_row(str(idx + 1), radar)
-        
+
         return radar_table
@@ -0,0 +1,102 @@
+from time import time
+from typing import Dict, List
+from .config import ConfigSingleton
+from .traps import TrapSettings
+
+# Keys typed for one trap, e.g. 'a', '1', 'enter'
+KEYS_PER_TRAP = 3
+
+# Picks the traps to type in each TRAP_TIMER_DURATION cycle
+#
+# A trap is due once `priority` cycles and its MIN_REFRESH_INTERVAL have passed since it was last typed.
+# Due traps are typed latest first, until the cycle budget is used: how long a trap waited, in cycles of its priority.
+# Traps that did not fit stay due and only get later, so a low priority trap is never starved by the others
+class TrapPlanner:
+    def __init__(self):
+        self.config = ConfigSingleton()
+
+        # Measured seconds per typed key, starts with the same estimate as KeyboardManager.key_wait_time
+        self.key_cost = self.config.snapshot.KEYBOARD_INPUT_DELAY*1.3
+        self.cycle_duration = 0.0 # How long the last trap cycle took
+
+        self.cycle = 0 # Amount of planned cycles
+        self.last_cycle = {} # Trap -> cycle it was last typed in
+        self.last_time = {} # Trap -> time it was last typed
+        self.measured_periods = {} # Trap -> seconds between its last two refreshes
+        self.planned = ([], {}) # The traps given to the last plan and their settings, swapped together for the readers
+
+    def record_cycle(self, keys_typed: int, elapsed: float) -> None:
+        '''Update the measured cost of a key with a finished trap cycle'''
+        self.cycle_duration = elapsed
+        if keys_typed == 0:
+            return
+        measured = elapsed / keys_typed
+        # Smooth it out, a single slow cycle should not halve the slice
+        self.key_cost = 0.7*self.key_cost + 0.3*measured
+
+    def slice_size(self) -> int:
+        '''The amount of traps that can be typed within the cycle budget'''
+        config = self.config.snapshot
+        budget = config.TRAP_TIMER_DURATION*config.TRAP_CYCLE_BUDGET
+        return max(1, int(budget / (KEYS_PER_TRAP*self.key_cost)))
+
+    def is_due(self, trap: str, settings: TrapSettings, now: float) -> bool:
+        if trap not in self.last_cycle:
+            return True
+        if self.cycle - self.last_cycle[trap] < settings.priority:
+            return False
+        return now - self.last_time[trap] >= settings.min_refresh_interval
+
+    def plan(self, traps: List[str], settings: Dict[str, TrapSettings]) -> List[str]:
+        '''The traps to type in the next cycle, weighted by their priority'''
+        self.cycle += 1
+        self.planned = (list(traps), settings)
+        now = time()
+
+        due = [trap for trap in traps if self.is_due(trap, settings[trap], now)]
+        # The latest first, never typed traps before all others
+        due.sort(key=lambda trap: (-self.lateness(trap, settings[trap], now), settings[trap].priority))
+        return due[:self.slice_size()]
+
+    def record_typed(self, traps: List[str]) -> None:
+        '''Count the traps as refreshed once their keys are typed, a cancelled refresh stays due'''
+        now = time()
+        for trap in traps:
+            if trap in self.last_time:
+                self.measured_periods[trap] = now - self.last_time[trap]
+            self.last_cycle[trap] = self.cycle
+            self.last_time[trap] = now
+
+    def lateness(self, trap: str, settings: TrapSettings, now: float) -> float:
+        '''How long a trap has waited, in refresh periods of its priority'''
+        if trap not in self.last_time:
+            return float("inf")
+        cycle = max(self.config.snapshot.TRAP_TIMER_DURATION, self.cycle_duration)
+        return (now - self.last_time[trap]) / (settings.priority*cycle)
+
+    def estimated_period(self, settings: TrapSettings, stretch: float) -> float:
+        cycle = max(self.config.snapshot.TRAP_TIMER_DURATION, self.cycle_duration)
+        return max(settings.priority*cycle*stretch, settings.min_refresh_interval)
+
+    def refresh_periods(self) -> Dict[str, float]:
+        '''The effective refresh period of every trap in the last plan, in seconds.
+
+        Uses the measured period once a trap has been typed twice, an estimate before that'''
+        planned_traps, planned_settings = self.planned
+        if len(planned_traps) == 0:
+            return {}
+        # How many traps want to be typed per cycle, compared to what fits
+        load = sum(1 / planned_settings[trap].priority for trap in planned_traps)
+        stretch = max(1.0, load / self.slice_size())
+
+        periods = {}
+        for trap in planned_traps:
+            if trap in self.measured_periods:
+                periods[trap] = self.measured_periods[trap]
+            else:
+                periods[trap] = self.estimated_period(planned_settings[trap], stretch)
+        return periods
+
+    def refresh_period(self) -> float:
+        '''Seconds between two refreshes of the slowest trap'''
+        return max(self.refresh_periods().values(), default=0.0)
@@ -0,0 +1,43 @@
+from logging import Logger
+from typing import Optional
+import threading
+from .traps import TrapRegistry
+
+# Writes the traps to TRAPS_FILE from a background thread, so the hook thread never waits for the disk.
+# Only the latest traps are written: changes made while a write is going on are saved together by the next one
+class TrapSaver:
+    def __init__(self, path: str, logger: Logger):
+        self.path = path
+        self.logger = logger
+
+        self.condition = threading.Condition()
+        self.pending: Optional[int] = None # The bits waiting to be written
+        self.running = True
+        self.thread = threading.Thread(target=self.save_loop, daemon=True)
+        self.thread.start()
+
+    def save(self, traps: TrapRegistry) -> None:
+        '''Request a write of the traps, never blocks the caller'''
+        with self.condition:
+            self.pending = traps.bits
+            self.condition.notify()
+
+    def save_loop(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                bits, self.pending = self.pending, None
+            try:
+                TrapRegistry(bits).save(self.path)
+            except OSError as e:
+                self.logger.error("Failed to save the traps: %s", e)
+
+    def stop(self) -> None:
+        '''Write what is still pending, then stop the thread'''
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,72 @@
+from time import monotonic
+from typing import Callable
+import threading
+from logging import Logger
+from .config import ConfigSingleton
+
+# The single worker that runs the automatic trap writing cycle every TRAP_TIMER_DURATION
+#
+# Cycles are scheduled against monotonic deadlines, so time spent typing is taken out of the wait.
+# When a cycle overruns its slot, the next one starts right away instead of bursting to catch up
+class TrapWriter:
+    def __init__(self, cycle: Callable[[], None], logger: Logger):
+        self.cycle = cycle # Types one round of traps
+        self.logger = logger
+        self.config = ConfigSingleton()
+
+        self.condition = threading.Condition()
+        self.running = True
+        self.paused = True
+        self.next_deadline = None # When the next cycle starts, monotonic seconds
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and self.paused:
+                    self.condition.wait()
+                if not self.running:
+                    return
+
+                # Sleep until the deadline, waking early on pause or stop
+                remaining = self.next_deadline - monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+
+                cycle_start = self.next_deadline
+
+            self.cycle()
+
+            with self.condition:
+                # A pause during the cycle resets the deadline on resume
+                if self.next_deadline != cycle_start:
+                    continue
+                self.next_deadline = cycle_start + self.config.snapshot.TRAP_TIMER_DURATION
+                now = monotonic()
+                if self.next_deadline < now:
+                    self.logger.debug("Trap cycle overran by %.3fs", now - self.next_deadline)
+                    self.next_deadline = now
+
+    def resume(self, delay: float = 0) -> None:
+        '''Start the cycles again, the first one after the delay'''
+        with self.condition:
+            if not self.paused:
+                return
+            self.paused = False
+            self.next_deadline = monotonic() + delay
+            self.condition.notify_all()
+
+    def pause(self) -> None:
+        with self.condition:
+            self.paused = True
+            self.next_deadline = None
+            self.condition.notify_all()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
@@ -1,3 +1,16 @@
+from typing import Dict, Iterable, Iterator, List, Optional
+import os
+from .config import ConfigSingleton
+
+# Every trap of the game, a0 to z9. The index of a trap is its bit in a TrapRegistry
+TRAP_COUNT = 260
+ALL_TRAPS = [f"{chr(i)}{j}" for i in range(ord('a'), ord('z')+1) for j in range(10)]
+ALL_BITS = (1 << TRAP_COUNT) - 1
+
+# Traps file: a header, then the bits of the registry
+TRAPS_MAGIC = b"LTTRAPS1"
+TRAPS_BYTES = (TRAP_COUNT + 7) // 8
+
 def is_valid_trap(trap: str) -> bool:
     if len(trap) != 2:
         return False
@@ -5,4 +18,128 @@ def is_valid_trap(trap: str) -> bool:
         return False
     if not trap[1].isdigit():
         return False
-    return True
\ No newline at end of file
+    return True
+
+def trap_index(trap: str) -> int:
+    '''The bit of a valid trap, a0 is 0 and z9 is 259'''
+    return (ord(trap[0]) - ord('a'))*10 + ord(trap[1]) - ord('0')
+
+def trap_bit(trap: str) -> int:
+    '''The bit of a trap, 0 when it is not a trap'''
+    if len(trap) != 2 or not 'a' <= trap[0] <= 'z' or not '0' <= trap[1] <= '9':
+        return 0
+    return 1 << trap_index(trap)
+
+def parse_trap_ranges(text: str) -> Optional[List[str]]:
+    '''The traps of a bulk entry, in order: items separated by spaces, each a trap (a1), a range (a0-a9, a0-c9),
+    a letter (c*) or every trap (*). None when an item is not valid'''
+    bits = 0
+    for item in text.split():
+        if item == '*':
+            bits |= ALL_BITS
+        elif len(item) == 2 and item[1] == '*':
+            first = trap_bit(item[0] + '0')
+            if not first:
+                return None
+            bits |= first*0x3FF # The 10 traps of the letter
+        elif '-' in item:
+            first, _, last = item.partition('-')
+            first_bit, last_bit = trap_bit(first), trap_bit(last)
+            if not first_bit or not last_bit or first_bit > last_bit:
+                return None
+            bits |= (last_bit << 1) - first_bit
+        else:
+            bit = trap_bit(item)
+            if not bit:
+                return None
+            bits |= bit
+    return list(TrapRegistry(bits))
+
+# The traps that are set, a bitset of the 260 traps of the game
+#
+# Adding, removing and looking up a trap is a bit operation, iterating goes from a0 to z9.
+# The bits are one int that is replaced on every change, so a thread iterating the traps never sees a half change
+class TrapRegistry:
+    def __init__(self, bits: int = 0):
+        self.bits = bits & ALL_BITS
+
+    def add(self, trap: str) -> bool:
+        '''Returns False when the trap is not valid or already added'''
+        bit = trap_bit(trap)
+        if not bit or self.bits & bit:
+            return False
+        self.bits |= bit
+        return True
+
+    def remove(self, trap: str) -> bool:
+        '''Returns False when the trap is not in the registry'''
+        bit = trap_bit(trap)
+        if not self.bits & bit:
+            return False
+        self.bits &= ~bit
+        return True
+
+    def update(self, traps: Iterable[str]) -> None:
+        for trap in traps:
+            self.add(trap)
+
+    def clear(self) -> None:
+        self.bits = 0
+
+    def __contains__(self, trap: str) -> bool:
+        return bool(self.bits & trap_bit(trap))
+
+    def __len__(self) -> int:
+        return bin(self.bits).count("1")
+
+    def __iter__(self) -> Iterator[str]:
+        bits = self.bits
+        while bits:
+            lowest = bits & -bits
+            yield ALL_TRAPS[lowest.bit_length() - 1]
+            bits ^= lowest
+
+    def save(self, path: str) -> None:
+        '''Write the traps to path, replacing it at once so a crash never leaves half a file'''
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(TRAPS_MAGIC + self.bits.to_bytes(TRAPS_BYTES, "little"))
+        os.replace(temporary, path)
+
+    @staticmethod
+    def load(path: str) -> "TrapRegistry":
+        '''The traps saved in path, empty when there is no such file'''
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return TrapRegistry()
+        if len(data) != len(TRAPS_MAGIC) + TRAPS_BYTES or not data.startswith(TRAPS_MAGIC):
+            raise ValueError(f"'{path}' is not a traps file")
+        return TrapRegistry(int.from_bytes(data[len(TRAPS_MAGIC):], "little"))
+
+# How often a trap wants to be typed
+class TrapSettings():
+    def __init__(self, priority: int = 1, min_refresh_interval: float = 0):
+        self.priority = priority # 1 is typed every cycle, 2 every second cycle, ...
+        self.min_refresh_interval = min_refresh_interval # Seconds before the trap can be typed again
+
+def load_trap_settings() -> Dict[str, TrapSettings]:
+    '''Read the per trap settings from the TRAP_SETTINGS in the config'''
+    config = ConfigSingleton()
+    settings = {}
+    for trap, values in config.get("TRAP_SETTINGS", {}).items():
+        trap = trap.lower()
+        if not is_valid_trap(trap):
+            continue
+        settings[trap] = TrapSettings(
+            max(1, int(values.get("PRIORITY", config.get("DEFAULT_TRAP_PRIORITY", 1)))),
+            float(values.get("MIN_REFRESH_INTERVAL", 0))
+        )
+    return settings
+
+def default_trap_settings(priority: Optional[int] = None) -> TrapSettings:
+    config = ConfigSingleton()
+    if priority is None:
+        priority = config.get("DEFAULT_TRAP_PRIORITY", 1)
+    return TrapSettings(priority, 0)